@@ -2,24 +2,90 @@ from dotenv import load_dotenv
 load_dotenv()
 
 import datetime
+import hashlib
+import hmac
+import json
+import mimetypes
 import os
+import queue
 import sys
+import time
 import traceback
 import uuid
-import threading
-import queue
-import time
-from typing import Callable
-from user_agents import parse as parse_user_agent
+import zlib
 from dataclasses import dataclass
-from flask import Flask, render_template, redirect, request, make_response
-from flask_compress import Compress
+from flask import Flask, Response, abort, before_render_template, g, jsonify, render_template, redirect, request, make_response, send_file, stream_template, template_rendered
+from jinja2 import FileSystemBytecodeCache
+
+import assets
+import code_jar
+import metrics
+from compression import CachingCompress
 
 app = Flask(__name__)
-Compress(app)
+
+### Request timing
+
+# Registered before CachingCompress: after_request functions run in reverse
+# order of registration, so the timings include compressing the response
+@app.before_request
+def start_request_timing():
+  metrics.start_request()
+
+@app.after_request
+def finish_request_timing(resp):
+  timings = metrics.current()
+  if timings is None:
+    return resp
+
+  # Streamed pages are rendered after the headers are sent, their render time
+  # only shows up in the histograms
+  resp.headers["Server-Timing"] = timings.server_timing()
+  labels = {
+    "endpoint": request.url_rule.rule if request.url_rule is not None else "unmatched",
+    "method": request.method,
+    "status": str(resp.status_code),
+  }
+
+  def record():
+    metrics.registry.observe("diddle_request_duration_seconds", labels, timings.elapsed())
+    metrics.registry.observe("diddle_request_db_seconds", labels, timings.db_seconds)
+    metrics.registry.observe("diddle_request_render_seconds", labels, timings.render_seconds)
+    metrics.registry.inc("diddle_request_db_queries_total", labels, timings.db_queries)
+    metrics.registry.inc("diddle_request_compress_seconds_total", labels, timings.compress_seconds)
+    db.check_query_counts(timings, f"{labels['method']} {labels['endpoint']}")
+    metrics.end_request()
+    metrics.registry.flush()
+
+  resp.call_on_close(record)
+  return resp
+
+@before_render_template.connect_via(app)
+def start_render_timing(sender, template, context, **extra):
+  g.render_start = time.perf_counter()
+
+@template_rendered.connect_via(app)
+def finish_render_timing(sender, template, context, **extra):
+  timings = metrics.current()
+  if timings is not None and not timings.streaming and "render_start" in g:
+    metrics.record_render(time.perf_counter() - g.pop("render_start"))
+
+compress = CachingCompress(app)
+app.jinja_env.globals["asset_url"] = assets.asset_url
+
+# Compiled templates are also kept on disk, so restarted processes skip compiling them
+JINJA_CACHE_DIR = os.getenv("JINJA_CACHE_DIR")
+if JINJA_CACHE_DIR:
+  os.makedirs(JINJA_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(JINJA_CACHE_DIR)
 
 import db
 import email_client
+import events
+import fragments
+import recurrence
+import tasks
+import ua_classifier
 
 BASE_URL = os.environ["BASE_URL"]
 
@@ -33,15 +99,9 @@ DESCRIPTION_MAX_LENGTH = 1000
 AUTHOR_NAME_MAX_LENGTH = 100
 AUTHOR_EMAIL_MAX_LENGTH = 100
 VOTER_NAME_MAX_LENGTH = 100
+API_BATCH_MAX_POLLS = 50
 
-Task = Callable[[], None]
-background_tasks_queue: queue.Queue[Task] = queue.Queue()
-
-def voter_selection_on_choice(voter_name: str, choice: db.Choice) -> int | None:
-  for vote in choice.votes:
-    if vote.voter_name == voter_name:
-      return vote.value
-  return None
+BACKGROUND_WORKERS = int(os.getenv("BACKGROUND_WORKERS", "2"))
 
 def error_page(message: str, code: int = 400):
   return render_template("error.html.j2", error=message), code
@@ -55,6 +115,145 @@ def error_handler(e):
   traceback.print_exception(e, file=sys.stderr)
   return error_page("Internal server error", 500)
 
+def templates_digest() -> str:
+  """Fingerprint of the templates, so that a deploy changes every page ETag."""
+  digest = hashlib.sha1()
+  templates_dir = os.path.join(app.root_path, app.template_folder or "templates")
+  for name in sorted(os.listdir(templates_dir)):
+    with open(os.path.join(templates_dir, name), "rb") as f:
+      digest.update(name.encode())
+      digest.update(f.read())
+  return digest.hexdigest()
+
+TEMPLATES_DIGEST = templates_digest()
+# Pages link to fingerprinted assets, a new asset changes their URLs
+ASSETS_DIGEST = assets.manifest_digest()
+
+def precompile_templates() -> None:
+  """Compiles every template now instead of on the first request that uses it.
+
+  With a preloading gunicorn master this happens once before the workers are
+  forked, they then share the compiled templates.
+  """
+  for name in app.jinja_env.list_templates():
+    app.jinja_env.get_template(name)
+
+precompile_templates()
+
+def page_etag(*parts) -> str:
+  """Builds an ETag from everything a rendered page depends on."""
+  key = "\0".join(str(part) for part in (TEMPLATES_DIGEST, ASSETS_DIGEST) + parts)
+  return hashlib.sha1(key.encode()).hexdigest()
+
+def matching_etag(etag: str) -> str | None:
+  """Returns the If-None-Match value that matches the ETag, if any.
+
+  Flask-Compress appends the content encoding to the ETag of compressed
+  responses, so "<etag>:gzip" matches as well.
+  """
+  for candidate in request.if_none_match.as_set(include_weak=True):
+    if candidate == etag or candidate.startswith(f"{etag}:"):
+      return candidate
+  return None
+
+def set_validators(resp, etag: str, stamp: db.PollStamp):
+  encoding = resp.headers.get("Content-Encoding")
+  # Same suffix as Flask-Compress uses, a compressed body needs its own ETag
+  resp.set_etag(f"{etag}:{encoding}" if encoding else etag)
+  resp.last_modified = stamp.updated_at
+  # Pages depend on cookies, so only the browser may store them and it has to revalidate
+  resp.headers["Cache-Control"] = "private, no-cache"
+  return resp
+
+def not_modified(etag: str, stamp: db.PollStamp):
+  matched = matching_etag(etag)
+  if matched is None:
+    return None
+
+  resp = make_response("", 304)
+  set_validators(resp, etag, stamp)
+  resp.headers["ETag"] = f'"{matched}"'
+  return resp
+
+# The first chunk of a streamed page is sent as soon as it has this many bytes
+# so that the page header shows up early, later chunks are larger
+STREAM_FIRST_CHUNK_SIZE = 1024
+STREAM_CHUNK_SIZE = 16 * 1024
+
+def buffered(chunks, first_size: int, size: int):
+  """Joins the many small strings a streamed template yields into larger chunks."""
+  buffer: list[str] = []
+  length = 0
+  limit = first_size
+  chunks = iter(chunks)
+  while True:
+    # Only the time spent rendering counts, not the time spent sending
+    start = time.perf_counter()
+    try:
+      chunk = next(chunks)
+    except StopIteration:
+      break
+    finally:
+      metrics.record_render(time.perf_counter() - start)
+    buffer.append(chunk)
+    length += len(chunk)
+    if length >= limit:
+      yield "".join(buffer)
+      buffer, length, limit = [], 0, size
+  if buffer:
+    yield "".join(buffer)
+
+def gzip_chunks(chunks):
+  compressor = zlib.compressobj(app.config["COMPRESS_LEVEL"], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+  for chunk in chunks:
+    start = time.perf_counter()
+    # A sync flush per chunk lets the browser render what has arrived so far
+    compressed = compressor.compress(chunk.encode()) + compressor.flush(zlib.Z_SYNC_FLUSH)
+    metrics.record_compress(time.perf_counter() - start)
+    yield compressed
+  yield compressor.flush()
+
+def stream_page(template_name: str, **context) -> Response:
+  """Renders a template as a streamed response, gzipped on the fly when the client accepts it.
+
+  The response is marked so that CachingCompress leaves it alone, it would
+  otherwise buffer the whole stream to compress it with another encoding.
+  """
+  timings = metrics.current()
+  if timings is not None:
+    timings.streaming = True
+  chunks = buffered(stream_template(template_name, **context),
+                    STREAM_FIRST_CHUNK_SIZE, STREAM_CHUNK_SIZE)
+  if "gzip" in request.accept_encodings:
+    resp = Response(gzip_chunks(chunks), mimetype="text/html")
+    resp.headers["Content-Encoding"] = "gzip"
+  else:
+    resp = Response(chunks, mimetype="text/html")
+  resp.skip_compression = True
+  resp.vary.add("Accept-Encoding")
+  return resp
+
+def codes() -> code_jar.CodeJar:
+  """The manage codes of the polls this browser created and of its votes."""
+  if "code_jar" not in g:
+    g.code_jar = code_jar.CodeJar.from_cookies(request.cookies)
+  return g.code_jar
+
+@app.after_request
+def save_codes(resp):
+  jar = g.get("code_jar")
+  if jar is None:
+    return resp
+
+  if jar.changed:
+    resp.set_cookie(code_jar.COOKIE_NAME, jar.dumps(),
+                    samesite="Strict", secure=False)
+  # The codes of the cookies of earlier versions are in the jar now
+  for name in jar.legacy_cookies:
+    resp.set_cookie(name, "", expires=0,
+                    samesite="Strict", secure=False)
+  return resp
+
 def validate_uuid(s: str) -> bool:
   try:
     uuid.UUID(s)
@@ -62,12 +261,31 @@ def validate_uuid(s: str) -> bool:
   except ValueError:
     return False
 
+# Fingerprinted assets never change, a new version has a new URL
+ASSET_MAX_AGE = 365 * 24 * 60 * 60
+
+@app.get("/assets/<filename>")
+def asset(filename):
+  path = assets.asset_path(filename)
+  if path is None:
+    abort(404)
+
+  mimetype = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+  for encoding, suffix in assets.ENCODINGS.items():
+    if encoding in request.accept_encodings and os.path.exists(path + suffix):
+      resp = send_file(path + suffix, mimetype=mimetype)
+      resp.headers["Content-Encoding"] = encoding
+      break
+  else:
+    resp = send_file(path, mimetype=mimetype)
+
+  resp.headers["Cache-Control"] = f"public, max-age={ASSET_MAX_AGE}, immutable"
+  resp.vary.add("Accept-Encoding")
+  return resp
+
 @app.route("/")
 def index():
-  created_poll_codes = []
-  for k, _ in request.cookies.items():
-    if k.startswith("diddle_manage_code_"):
-      created_poll_codes.append(k.replace("diddle_manage_code_", ""))
+  created_poll_codes = list(codes().codes("manage"))
 
   created_polls = db.get_polls_by_codes(created_poll_codes) if len(created_poll_codes) > 0 else []
 
@@ -106,23 +324,44 @@ def create():
     author_name,
     author_email,
     "is_whole_day" in form,
+    notify=email_client.email_enabled,
   )
 
-  if email_client.email_enabled:
-    def task():
-      email_client.send_poll_created_email(poll_id=poll.id)
-
-    background_tasks_queue.put(task)
-
-  resp = make_response(
-    redirect(f"/manage/{poll.manage_code}")
-  )
-  resp.set_cookie(f"diddle_manage_code_{poll.manage_code}", "1",
-                  samesite="Strict", secure=False)
-  return resp
-
+  codes().add("manage", poll.manage_code)
+  return redirect(f"/manage/{poll.manage_code}")
+
+
+def poll_page_context(poll: db.Poll,
+                      display_mode: str,
+                      voter_codes: list[str],
+                      prefill_voter_name: str | None,
+                      now: datetime.datetime,
+                      editing: db.VoterVotes | None = None) -> dict:
+  """The context of poll.html.j2 for one viewer."""
+  # The parts shared by every viewer come from the fragment cache, the rest is
+  # rendered per request while the page streams
+  table_header = None
+  voter_rows = iter(())
+  choice_items = iter(())
+  if display_mode == "table":
+    table_header = fragments.table_header(poll, now)
+    voter_rows = fragments.voter_rows(poll)
+  else:
+    choice_items = fragments.choice_items(poll, now)
+
+  return dict(poll=poll,
+              choices=poll.choices,
+              table_header=table_header,
+              voter_rows=voter_rows,
+              choice_items=choice_items,
+              prefill_voter_name=prefill_voter_name,
+              editing=editing,
+              managed_voter_names=poll.managed_voter_names(set(voter_codes)),
+              best_choice_ids=poll.best_choice_ids(),
+              now=now,
+              display_mode=display_mode,
+              live_updates=events.hub.enabled)
 
-VoterNameChoiceIdPair = tuple[str, str]
 @app.get("/poll/<id>")
 def poll(id):
   if not validate_uuid(id):
@@ -130,54 +369,109 @@ def poll(id):
 
   prefill_voter_name = request.args.get("prefill_voter_name")
 
-  voter_codes: list[str] = []
-  for k, _ in request.cookies.items():
-    if k.startswith("diddle_voter_code_"):
-      voter_codes.append(k.replace("diddle_voter_code_", ""))
+  voter_codes = sorted(codes().codes("voter"))
+  # Voters can edit the votes whose codes their browser has
+  edit_code = request.args.get("edit")
+  if edit_code not in voter_codes:
+    edit_code = None
 
-  poll = db.get_poll(id)
-  if poll is None:
+  stamp = db.get_poll_stamp(id)
+  if stamp is None:
     return error_page("Poll not found", 404)
 
   display_mode_cookie = request.cookies.get("diddle_display_mode")
   if display_mode_cookie is None:
-    user_agent = parse_user_agent(request.user_agent.string)
-    if user_agent.is_mobile or user_agent.is_tablet:
+    if ua_classifier.classify(request.user_agent.string) in ("mobile", "tablet"):
       display_mode = "list"
     else:
       display_mode = "table"
   else:
     display_mode = display_mode_cookie
 
-  voter_names_set: set[str] = set()
-  selections: dict[VoterNameChoiceIdPair, int] = {}
-  managed_voter_names: dict[str, str] = {}
-  for choice in poll.choices:
-    for vote in choice.votes:
-      selections[(vote.voter_name, choice.id)] = vote.value
-      voter_names_set.add(vote.voter_name)
-
-      if vote.manage_code in voter_codes:
-        managed_voter_names[vote.voter_name] = vote.manage_code
-
-  voter_names = list(voter_names_set)
-  voter_names.sort()
-
-  resp = make_response(
-    render_template("poll.html.j2",
-                    poll=poll,
-                    selections=selections,
-                    choices=poll.choices,
-                    prefill_voter_name=prefill_voter_name,
-                    voter_names=voter_names,
-                    managed_voter_names=managed_voter_names,
-                    now=datetime.datetime.now(),
-                    display_mode=display_mode))
+  now = datetime.datetime.now()
+  def etag_for(version: int) -> str:
+    return page_etag(id, version, display_mode, prefill_voter_name, edit_code,
+                     ",".join(voter_codes), now.year, events.hub.enabled)
+
+  resp = not_modified(etag_for(stamp.version), stamp)
+  if resp is not None:
+    resp.set_cookie("diddle_display_mode", display_mode,
+                    samesite="Lax", secure=False)
+    return resp
+
+  poll = db.get_poll(id)
+  if poll is None:
+    return error_page("Poll not found", 404)
+
+  editing = db.get_voter_votes(id, edit_code) if edit_code is not None else None
+  context = poll_page_context(poll, display_mode, voter_codes, prefill_voter_name, now, editing)
+  # Codes that are still in use are kept when the cookie has to drop some
+  codes().touch("voter", context["managed_voter_names"].values())
+  resp = stream_page("poll.html.j2", **context)
+  # The poll may have changed since the stamp was read, describe what was rendered
+  set_validators(resp, etag_for(poll.version), poll.stamp())
 
   resp.set_cookie("diddle_display_mode", display_mode,
                   samesite="Lax", secure=False)
   return resp
 
+# How long a new stream waits for the notification listener before reading the
+# poll version, so that its first connect does not look like missed events
+LISTENER_CONNECT_WAIT_SECONDS = 2.0
+
+@app.get("/poll/<id>/events")
+def poll_events(id):
+  if not validate_uuid(id):
+    return error_page("Invalid poll ID", 400)
+  if not events.hub.enabled:
+    return error_page("Not found", 404)
+
+  db.listener.wait_connected(LISTENER_CONNECT_WAIT_SECONDS)
+
+  # Subscribe before reading the version, a change in between is then both
+  # reflected in the version and delivered as an event
+  subscriber = events.hub.subscribe(id)
+  if subscriber is None:
+    return error_page("Too many live connections, try again later", 503)
+
+  try:
+    stamp = db.get_poll_stamp(id)
+  except Exception:
+    events.hub.unsubscribe(id, subscriber)
+    raise
+  if stamp is None:
+    events.hub.unsubscribe(id, subscriber)
+    return error_page("Poll not found", 404)
+
+  known_version = request.headers.get("Last-Event-ID") or request.args.get("version")
+
+  def stream():
+    try:
+      yield "retry: 5000\n\n"
+      if known_version != str(stamp.version):
+        yield events.format_event(json.dumps({
+          "poll_id": id,
+          "version": stamp.version,
+          "event": "changed",
+        }))
+
+      deadline = time.monotonic() + events.SSE_MAX_STREAM_SECONDS
+      while time.monotonic() < deadline:
+        try:
+          payload = subscriber.get(timeout=events.SSE_HEARTBEAT_SECONDS)
+        except queue.Empty:
+          # Keeps proxies from closing the idle connection
+          yield ": heartbeat\n\n"
+          continue
+        yield events.format_event(payload)
+    finally:
+      events.hub.unsubscribe(id, subscriber)
+
+  return Response(stream(), mimetype="text/event-stream", headers={
+    "Cache-Control": "no-cache",
+    "X-Accel-Buffering": "no",
+  })
+
 
 @app.post("/poll/<id>/vote")
 def vote_poll(id):
@@ -205,21 +499,42 @@ def vote_poll(id):
       choice_id = k.replace("choice_", "")
       selections[choice_id] = 1
 
-  manage_code = db.vote_poll(id, voter_name, selections)
+  manage_code = db.vote_poll(id, voter_name, selections,
+                             notify=email_client.email_enabled,
+                             digest_window=email_client.EMAIL_DIGEST_WINDOW)
   if manage_code is None:
     return error_page("That name is already in use")
 
-  if email_client.email_enabled:
-    def task():
-      email_client.send_participation_email(poll_id=id, voter_name=voter_name)
-    background_tasks_queue.put(task)
+  codes().add("voter", manage_code)
+  return redirect(f"/poll/{id}")
 
-  response = make_response(
-    redirect(f"/poll/{id}")
-  )
-  response.set_cookie(f"diddle_voter_code_{manage_code}", "1",
-                      samesite="Strict", secure=False)
-  return response
+@app.post("/poll/<id>/edit_vote")
+def edit_vote(id):
+  if not validate_uuid(id):
+    return error_page("Invalid poll ID", 400)
+
+  form = request.form
+  voter_code = form.get("voter_code", "")
+  if not validate_uuid(voter_code):
+    return error_page("Invalid voter code", 400)
+
+  # The form has the value every cell had when the page was rendered, only
+  # the cells that differ from it are written
+  changes: dict[str, int] = {}
+  for k in form.keys():
+    if k.startswith("cell_"):
+      choice_id = k.replace("cell_", "")
+      if not validate_uuid(choice_id):
+        return error_page("Invalid option", 400)
+      value = 1 if f"choice_{choice_id}" in form else 0
+      if form[k] != str(value):
+        changes[choice_id] = value
+
+  if changes and db.update_votes(id, voter_code, changes) is None:
+    return error_page("Vote not found", 404)
+
+  codes().add("voter", voter_code)
+  return redirect(f"/poll/{id}")
 
 @app.post("/poll/<id>/delete_voter")
 def delete_voter(id):
@@ -234,12 +549,8 @@ def delete_voter(id):
 
   db.delete_voter(voter_manage_code)
 
-  resp = make_response(
-    redirect(f"/poll/{id}?prefill_voter_name={voter_name}")
-  )
-  resp.set_cookie(f"diddle_voter_code_{voter_manage_code}", "", expires=0,
-                  samesite="Strict", secure=False)
-  return resp
+  codes().remove("voter", voter_manage_code)
+  return redirect(f"/poll/{id}?prefill_voter_name={voter_name}")
 
 @app.post("/manage/<code>/update_info")
 def update_poll_info(code):
@@ -304,11 +615,92 @@ def add_choice(code):
   if len(end_datetime) == 10:
     end_datetime += "T23:59"
 
-  db.add_choice_to_poll(
-    code,
-    start_datetime,
-    end_datetime,
-  )
+  if db.add_choices_to_poll(code, [(start_datetime, end_datetime)]) is None:
+    return error_page("Poll not found", 404)
+
+  return redirect(f"/manage/{code}?focus_next=1")
+
+def parse_form_date(value: str | None, field: str) -> datetime.date:
+  try:
+    return datetime.date.fromisoformat(value or "")
+  except ValueError:
+    raise ValueError(f"{field} must be a date")
+
+def parse_form_time(value: str | None, field: str) -> datetime.time | None:
+  if not value:
+    return None
+  try:
+    return datetime.time.fromisoformat(value)
+  except ValueError:
+    raise ValueError(f"{field} must be a time")
+
+def parse_form_datetime(value: str, whole_day_end: bool) -> datetime.datetime:
+  """A datetime-local or date input value, dates are the start or the end of the day."""
+  if len(value) == 10:
+    date = datetime.date.fromisoformat(value)
+    start, end = recurrence.whole_day(date)
+    return end if whole_day_end else start
+  return datetime.datetime.fromisoformat(value)
+
+def choice_ranges_from_form(form) -> list[recurrence.ChoiceRange]:
+  """The choices of the add options form, a list of ranges or a recurrence rule.
+
+  Raises ValueError with a message for the user if the form is invalid.
+  """
+  if form.get("mode") == "series":
+    weekdays = set()
+    for weekday in form.getlist("repeat_weekday"):
+      if not weekday.isdigit() or int(weekday) > 6:
+        raise ValueError("Invalid weekday")
+      weekdays.add(int(weekday))
+    slot_minutes = form.get("repeat_slot_minutes")
+    if slot_minutes and not slot_minutes.isdigit():
+      raise ValueError("Slot length must be a number of minutes")
+    return recurrence.expand(
+      parse_form_date(form.get("repeat_first_date"), "First date"),
+      parse_form_date(form.get("repeat_last_date"), "Last date"),
+      weekdays,
+      parse_form_time(form.get("repeat_start_time"), "Start time"),
+      parse_form_time(form.get("repeat_end_time"), "End time"),
+      int(slot_minutes) if slot_minutes else None,
+    )
+
+  starts = form.getlist("start_datetime")
+  ends = form.getlist("end_datetime")
+  if len(starts) != len(ends):
+    raise ValueError("Every option needs a start and an end datetime")
+  if len(starts) > recurrence.MAX_CHOICES:
+    raise ValueError(f"At most {recurrence.MAX_CHOICES} options can be added at once")
+
+  ranges = []
+  for start, end in zip(starts, ends):
+    if len(start) == 0 and len(end) == 0:
+      continue
+    if len(start) == 0 or len(end) == 0:
+      raise ValueError("Every option needs a start and an end datetime")
+    try:
+      choice_range = (parse_form_datetime(start, False), parse_form_datetime(end, True))
+    except ValueError:
+      raise ValueError(f"Invalid datetime: {start} - {end}")
+    if choice_range[0] > choice_range[1]:
+      raise ValueError("Start datetime must be before end datetime")
+    ranges.append(choice_range)
+  if len(ranges) == 0:
+    raise ValueError("Add at least one option")
+  return ranges
+
+@app.post("/manage/<code>/add_choices")
+def add_choices(code):
+  if not validate_uuid(code):
+    return error_page("Invalid manage code", 400)
+
+  try:
+    ranges = choice_ranges_from_form(request.form)
+  except ValueError as e:
+    return error_page(str(e))
+
+  if db.add_choices_to_poll(code, ranges) is None:
+    return error_page("Poll not found", 404)
 
   return redirect(f"/manage/{code}?focus_next=1")
 
@@ -317,30 +709,40 @@ def delete_choice(code, choice_id):
   if not validate_uuid(code):
     return error_page("Invalid manage code", 400)
 
-  poll = db.get_poll_by_code(code)
-  if poll is None:
-    return error_page("Poll not found", code=404)
+  if not validate_uuid(choice_id):
+    return error_page("Invalid option", 400)
 
-  db.delete_choice(choice_id)
+  if not db.delete_choice(code, choice_id):
+    return error_page("Option not found", 404)
 
   return redirect(f"/manage/{code}?focus_next=1")
 
+def manage_page_context(poll: db.Poll) -> dict:
+  """The context of manage.html.j2."""
+  last_choice_id = poll.choices[-1].id if len(poll.choices) > 0 else None
+  return dict(poll=poll,
+              last_choice_id=last_choice_id,
+              best_choice_ids=poll.best_choice_ids())
+
 @app.get("/manage/<code>")
 def manage(code):
   if not validate_uuid(code):
     return error_page("Invalid manage code", 400)
 
-  poll = db.get_poll_by_code(code)
-  if poll is None:
+  stamp = db.get_poll_stamp_by_code(code)
+  if stamp is None:
     return error_page("Poll not found")
 
-  last_choice_id = poll.choices[-1].id if len(poll.choices) > 0 else None
-  resp = make_response(
-    render_template("manage.html.j2",
-                    poll=poll,
-                    last_choice_id=last_choice_id))
-  resp.set_cookie(f"diddle_manage_code_{code}", "1",
-                  samesite="Strict", secure=False)
+  resp = not_modified(page_etag(code, stamp.version), stamp)
+  if resp is None:
+    poll = db.get_poll_by_code(code)
+    if poll is None:
+      return error_page("Poll not found")
+
+    resp = make_response(render_template("manage.html.j2", **manage_page_context(poll)))
+    set_validators(resp, page_etag(code, poll.version), poll.stamp())
+
+  codes().add("manage", code)
   return resp
 
 @app.post("/manage/<code>/delete")
@@ -348,7 +750,10 @@ def delete_poll(code):
   if not validate_uuid(code):
     return error_page("Invalid manage code", 400)
 
-  poll = db.get_poll_by_code(code)
+  poll = db.get_poll_title_by_code(code)
+  if poll is None:
+    return error_page("Poll not found", 404)
+
   return render_template("poll_confirm_delete.html.j2", poll=poll)
 
 @app.post("/manage/<code>/confirm_delete")
@@ -357,10 +762,8 @@ def confirm_delete_poll(code):
     return error_page("Invalid manage code", 400)
 
   db.delete_poll(code)
-  resp = make_response(redirect("/"))
-  resp.set_cookie(f"diddle_manage_code_{code}", "", expires=0,
-                  samesite="Strict", secure=False)
-  return resp
+  codes().remove("manage", code)
+  return redirect("/")
 
 @app.post("/options/toggle_display_mode")
 def toggle_display_mode():
@@ -377,13 +780,149 @@ def toggle_display_mode():
                   samesite="Lax", secure=False)
   return resp
 
+### JSON API
+
+def api_error(message: str, code: int = 400):
+  return jsonify(error=message), code
+
+# Part of the API ETags, bump it when poll_document() changes so that clients
+# do not keep documents of the old shape
+API_DOCUMENT_VERSION = 2
+
+def poll_document(poll: db.Poll, manage: bool = False) -> dict:
+  """Describes a loaded poll for API clients, voter values are ordered like choices."""
+  document = {
+    "id": poll.id,
+    "version": poll.version,
+    "updated_at": poll.updated_at.isoformat(),
+    "title": poll.title,
+    "description": poll.description,
+    "author_name": poll.author_name,
+    "pub_date": poll.pub_date.isoformat(),
+    "whole_day": poll.is_whole_day,
+    "choices": [
+      {
+        "id": choice.id,
+        "start": choice.start_datetime.isoformat(),
+        "end": choice.end_datetime.isoformat(),
+        "yes_count": choice.yes_count,
+        "no_count": choice.no_count,
+      }
+      for choice in poll.choices
+    ],
+    "ranking": [choice.id for choice in poll.ranked_choices()],
+    "voters": [
+      {
+        "name": row.name,
+        "values": [None if value == db.PollResults.NO_VOTE else value for value in row.values],
+      }
+      for row in poll.voter_rows()
+    ],
+  }
+  if manage:
+    document["manage_code"] = poll.manage_code
+    document["author_email"] = poll.author_email
+  return document
+
+@app.get("/api/poll/<id>")
+def api_poll(id):
+  if not validate_uuid(id):
+    return api_error("Invalid poll ID", 400)
+
+  stamp = db.get_poll_stamp(id)
+  if stamp is None:
+    return api_error("Poll not found", 404)
+
+  resp = not_modified(page_etag("api", API_DOCUMENT_VERSION, id, stamp.version), stamp)
+  if resp is None:
+    poll = db.get_poll(id)
+    if poll is None:
+      return api_error("Poll not found", 404)
+
+    resp = jsonify(poll_document(poll))
+    set_validators(resp, page_etag("api", API_DOCUMENT_VERSION, id, poll.version), poll.stamp())
+  return resp
+
+@app.get("/api/manage/<code>")
+def api_manage(code):
+  if not validate_uuid(code):
+    return api_error("Invalid manage code", 400)
+
+  stamp = db.get_poll_stamp_by_code(code)
+  if stamp is None:
+    return api_error("Poll not found", 404)
+
+  resp = not_modified(page_etag("api", API_DOCUMENT_VERSION, code, stamp.version), stamp)
+  if resp is None:
+    poll = db.get_poll_by_code(code)
+    if poll is None:
+      return api_error("Poll not found", 404)
+
+    resp = jsonify(poll_document(poll, manage=True))
+    set_validators(resp, page_etag("api", API_DOCUMENT_VERSION, code, poll.version), poll.stamp())
+  return resp
+
+@app.get("/api/polls")
+def api_polls():
+  """Returns several polls at once, ids are given as ?ids=<id>,<id>,..."""
+  ids = [id.strip() for id in request.args.get("ids", "").split(",") if id.strip()]
+  if len(ids) == 0:
+    return api_error("At least one poll ID is required")
+  if len(ids) > API_BATCH_MAX_POLLS:
+    return api_error(f"At most {API_BATCH_MAX_POLLS} polls can be fetched at once")
+  if not all(validate_uuid(id) for id in ids):
+    return api_error("Invalid poll ID")
+
+  ids = list(dict.fromkeys(str(uuid.UUID(id)) for id in ids))
+  polls = db.get_polls(ids)
+  found_ids = {poll.id for poll in polls}
+
+  missing = [id for id in ids if id not in found_ids]
+  if len(polls) == 0:
+    return jsonify(polls=[], missing=missing)
+
+  etag = page_etag("api", API_DOCUMENT_VERSION, *(f"{poll.id}:{poll.version}" for poll in polls), *missing)
+  stamp = max(polls, key=lambda poll: poll.updated_at).stamp()
+  resp = not_modified(etag, stamp)
+  if resp is None:
+    resp = jsonify(polls=[poll_document(poll) for poll in polls], missing=missing)
+    set_validators(resp, etag, stamp)
+  return resp
+
+### Metrics
+
+metrics.registry.register_stats("db_pool", db.pool_stats)
+metrics.registry.register_stats("poll_cache", db.poll_cache_stats)
+metrics.registry.register_stats("fragment_cache", fragments.stats)
+metrics.registry.register_stats("compress_cache", compress.stats)
+metrics.registry.register_stats("ua_classifier", ua_classifier.stats)
+metrics.registry.register_stats("email", email_client.stats)
+metrics.registry.register_stats("live_updates", events.hub.stats)
+
+# Without a token the endpoint is public
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+@app.before_request
+def start_metrics_flushing():
+  metrics.registry.ensure_flushing()
+
+@app.get("/metrics")
+def prometheus_metrics():
+  if METRICS_TOKEN:
+    authorization = request.headers.get("Authorization", "")
+    if not hmac.compare_digest(authorization.encode(), f"Bearer {METRICS_TOKEN}".encode()):
+      abort(404)
+  return Response(metrics.collect(), mimetype="text/plain; version=0.0.4")
+
 ### Background thread
 
-def background_thread():
-  print("Background thread started")
-  while True:
-    task = background_tasks_queue.get()
-    task()
-    time.sleep(0.1)
+metrics.registry.register_stats("background", lambda: {"workers": BACKGROUND_WORKERS})
+# The queue is shared by all processes, it is counted once per scrape
+metrics.registry.register_global_stats("outbox", db.outbox_stats)
 
-threading.Thread(target=background_thread, daemon=True).start()
+# Emails are sent from the outbox, either by these threads or by worker.py.
+# They are started by the first request of each process rather than on import,
+# threads started in a preloading gunicorn master would not survive the fork.
+@app.before_request
+def start_background_workers():
+  tasks.ensure_workers(BACKGROUND_WORKERS)
@@ -1,33 +1,116 @@
+"""Applies the pending migrations in migrations/ in order of their numbers.
+
+Safe to run from several replicas at once: the runs are serialized by an
+advisory lock. When nothing is pending, which is the usual case on startup,
+the applied migrations are checked with a single query and no lock is taken.
+
+The checksum of every applied migration is recorded, a migration file that
+was changed after it was applied stops the run.
+
+A migration whose first line is
+
+    -- migrate:no-transaction
+
+runs outside of a transaction, one statement at a time, which CREATE INDEX
+CONCURRENTLY requires. Statements are separated by a semicolon at the end of
+a line. Such a migration is recorded only after all of its statements
+succeeded and runs again from the start after a failure, so its statements
+must be safe to repeat.
+"""
 from dotenv import load_dotenv
 load_dotenv()
 
+import hashlib
 import os
+import re
+import time
+from typing import NamedTuple
+
 import db
 
-migrations_dir = 'migrations'  # Relative directory path
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "migrations")
+NO_TRANSACTION_MARKER = "-- migrate:no-transaction"
+
+class Migration(NamedTuple):
+  number: int
+  name: str
+  sql: str
+  checksum: str
+
+  @property
+  def transactional(self) -> bool:
+    return not self.sql.lstrip().startswith(NO_TRANSACTION_MARKER)
+
+  def statements(self) -> list[str]:
+    if self.transactional:
+      return [self.sql]
+    statements = (statement.strip() for statement in re.split(r";[ \t]*(?:\n|$)", self.sql))
+    # Drops the chunks that are only comments, e.g. the marker
+    return [statement for statement in statements
+            if any(line.strip() and not line.strip().startswith("--") for line in statement.splitlines())]
 
-# Get all migration files
-migration_files = sorted(os.listdir(migrations_dir))
+def load_migrations() -> list[Migration]:
+  migrations = []
+  for name in sorted(os.listdir(MIGRATIONS_DIR)):
+    if not name.endswith(".sql"):
+      continue
+    with open(os.path.join(MIGRATIONS_DIR, name), "rb") as f:
+      content = f.read()
+    migrations.append(Migration(number=int(name.split("_")[0]),
+                                name=name,
+                                sql=content.decode(),
+                                checksum=hashlib.sha256(content).hexdigest()))
+  return migrations
 
-db.ensure_migration_table_exists()
+def check_changed(migrations: list[Migration], applied: dict[int, str | None]) -> None:
+  for migration in migrations:
+    checksum = applied.get(migration.number)
+    if checksum is not None and checksum != migration.checksum:
+      raise Exception(f"Migration {migration.name} was changed after it was applied, "
+                      f"add a new migration instead")
 
-num_applied = 0
+def up_to_date(migrations: list[Migration], applied: dict[int, str | None] | None) -> bool:
+  return applied is not None and all(applied.get(migration.number) is not None
+                                     for migration in migrations)
 
-# Apply migrations in alphabetical order
-for migration_file in migration_files:
-  migration_path = os.path.join(migrations_dir, migration_file)
-  print(f"* Applying migration: {migration_path}")
+def run() -> int:
+  """Applies the pending migrations, returns how many were applied."""
+  migrations = load_migrations()
+  conn = db.connect_for_migrations()
+  try:
+    applied = db.get_applied_migrations(conn)
+    if applied is not None:
+      check_changed(migrations, applied)
+    if up_to_date(migrations, applied):
+      return 0
 
-  with open(migration_path, 'r') as f:
-    migration_sql = f.read()
+    db.lock_migrations(conn)
+    try:
+      db.ensure_migration_table_exists(conn)
+      # Another replica may have applied them while this one waited for the lock
+      applied = db.get_applied_migrations(conn)
+      check_changed(migrations, applied)
 
-  print(migration_sql)
-  number = int(migration_file.split('_')[0])
+      num_applied = 0
+      for migration in migrations:
+        if migration.number in applied:
+          if applied[migration.number] is None:
+            db.record_migration_checksum(conn, migration.number, migration.checksum)
+          continue
 
-  if db.ensure_migration_applied(number, migration_sql):
-    print(f"* Migration applied: {migration_path}\n")
-    num_applied += 1
-  else:
-    print(f"* Migration already applied: {migration_path}\n")
+        mode = "" if migration.transactional else " without a transaction"
+        print(f"* Applying migration {migration.name}{mode}")
+        start = time.perf_counter()
+        db.apply_migration(conn, migration.number, migration.checksum,
+                           migration.statements(), migration.transactional)
+        print(f"* Migration applied: {migration.name} ({time.perf_counter() - start:.1f} s)")
+        num_applied += 1
+      return num_applied
+    finally:
+      db.unlock_migrations(conn)
+  finally:
+    conn.close()
 
-print(f"* {num_applied} migrations applied.")
+if __name__ == "__main__":
+  num_applied = run()
+  print(f"* {num_applied} migrations applied.")
@@ -0,0 +1,94 @@
+"""Fingerprinted static assets.
+
+Running this module copies every file in static/ to static/dist/ under a name
+that contains a hash of its content, next to gzip and Brotli compressed
+versions, and writes a manifest of the new names:
+
+    python assets.py
+
+Pages link to assets with asset_url(), which returns the fingerprinted URL when
+the assets have been built and the plain static URL otherwise. A fingerprinted
+file never changes, so it can be cached forever.
+"""
+import gzip
+import hashlib
+import json
+import os
+import shutil
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+STATIC_DIR = os.path.join(ROOT_DIR, "static")
+DIST_DIR = os.path.join(STATIC_DIR, "dist")
+MANIFEST_PATH = os.path.join(DIST_DIR, "manifest.json")
+
+# Precompressed versions, in order of preference
+ENCODINGS = {"br": ".br", "gzip": ".gz"}
+# Files smaller than this are not worth compressing
+COMPRESS_MIN_SIZE = 500
+
+def fingerprinted_name(name: str, content: bytes) -> str:
+  stem, ext = os.path.splitext(name)
+  return f"{stem}.{hashlib.sha256(content).hexdigest()[:16]}{ext}"
+
+def build() -> dict[str, str]:
+  """Writes the fingerprinted and precompressed assets, returns the manifest."""
+  import brotli
+
+  shutil.rmtree(DIST_DIR, ignore_errors=True)
+  os.makedirs(DIST_DIR)
+
+  manifest: dict[str, str] = {}
+  for name in sorted(os.listdir(STATIC_DIR)):
+    path = os.path.join(STATIC_DIR, name)
+    if not os.path.isfile(path):
+      continue
+
+    with open(path, "rb") as f:
+      content = f.read()
+
+    built_name = fingerprinted_name(name, content)
+    built_path = os.path.join(DIST_DIR, built_name)
+    with open(built_path, "wb") as f:
+      f.write(content)
+
+    if len(content) >= COMPRESS_MIN_SIZE:
+      with open(built_path + ENCODINGS["gzip"], "wb") as f:
+        # mtime=0 keeps the output identical between builds
+        f.write(gzip.compress(content, compresslevel=9, mtime=0))
+      with open(built_path + ENCODINGS["br"], "wb") as f:
+        f.write(brotli.compress(content, quality=11))
+
+    manifest[name] = built_name
+    print(f"{name} -> dist/{built_name}")
+
+  with open(MANIFEST_PATH, "w") as f:
+    json.dump(manifest, f, indent=2, sort_keys=True)
+  return manifest
+
+def load_manifest() -> dict[str, str]:
+  try:
+    with open(MANIFEST_PATH) as f:
+      return json.load(f)
+  except FileNotFoundError:
+    return {}
+
+manifest = load_manifest()
+
+def manifest_digest() -> str:
+  """Changes whenever an asset does, pages that link to assets include it in their ETag."""
+  return hashlib.sha1(json.dumps(manifest, sort_keys=True).encode()).hexdigest()
+
+def asset_url(name: str) -> str:
+  built_name = manifest.get(name)
+  if built_name is None:
+    return f"/static/{name}"
+  return f"/assets/{built_name}"
+
+def asset_path(built_name: str) -> str | None:
+  """The path of a built asset, None if there is no such asset."""
+  if built_name not in manifest.values():
+    return None
+  return os.path.join(DIST_DIR, built_name)
+
+if __name__ == "__main__":
+  build()
@@ -0,0 +1,109 @@
+"""Compares the single-statement poll loader against the legacy three-query loader.
+
+Seeds synthetic polls of increasing size into the configured database, times
+both loaders and removes the polls afterwards. Run from the repository root:
+
+    python benchmarks/bench_get_poll.py --sizes 10x50,60x400 --repeat 20
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import datetime
+import os
+import sys
+import time
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BASE_URL", "http://localhost:8000")
+
+import db
+import legacy
+
+def legacy_get_poll(id: str):
+  """The loader as it was before it was reduced to a single statement."""
+  with db.db.cursor() as (conn, cur):
+    try:
+      cur.execute("SELECT * FROM polls WHERE id = %s", (id,))
+      poll_t = cur.fetchone()
+      if poll_t is None:
+        return None
+
+      poll = db.tuple_to_poll(poll_t)
+      cur.execute("SELECT * FROM choices "
+                  "WHERE poll_id = %s "
+                  "ORDER BY start_datetime", (id,))
+      choice_ts = cur.fetchall()
+
+      cur.execute("SELECT * FROM votes "
+                  "WHERE poll_id = %s "
+                  "ORDER BY voter_name", (id,))
+      vote_ts = cur.fetchall()
+
+      # Choices no longer carry their votes, keep them aside to preserve the old loop
+      votes_by_choice: dict[str, list[legacy.Vote]] = {}
+      for choice_t in choice_ts:
+        choice = legacy.tuple_to_choice(choice_t)
+        votes_by_choice[choice.id] = []
+
+        for vote_t in vote_ts:
+          vote = legacy.tuple_to_vote(vote_t)
+          if vote.choice_id == choice.id:
+            votes_by_choice[choice.id].append(vote)
+
+        poll.choices.append(choice)
+
+      conn.commit()
+      return poll
+    except Exception as e:
+      conn.rollback()
+      raise e
+
+def seed_poll(num_choices: int, num_voters: int) -> db.Poll:
+  poll = db.create_poll(f"bench {num_choices}x{num_voters}", None, "bench", None, False)
+  start = datetime.datetime(2030, 1, 1, 8, 0)
+  slots = [start + datetime.timedelta(hours=i) for i in range(num_choices)]
+  db.add_choices_to_poll(poll.manage_code, [(slot, slot + datetime.timedelta(hours=1)) for slot in slots])
+
+  loaded = db.get_poll(poll.id)
+  assert loaded is not None
+  for v in range(num_voters):
+    selections = {choice.id: (v + i) % 2 for i, choice in enumerate(loaded.choices)}
+    db.vote_poll(poll.id, f"voter {v:05d} {uuid.uuid4().hex[:6]}", selections)
+
+  return poll
+
+def time_loader(loader, poll_id: str, repeat: int, setup=None) -> float:
+  """Returns the median wall time of the loader in milliseconds, setup runs untimed before each call."""
+  samples = []
+  for _ in range(repeat):
+    if setup is not None:
+      setup()
+    start = time.perf_counter()
+    loader(poll_id)
+    samples.append((time.perf_counter() - start) * 1000)
+  samples.sort()
+  return samples[len(samples) // 2]
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--sizes", default="5x10,20x50,60x400",
+                      help="comma separated CHOICESxVOTERS poll shapes")
+  parser.add_argument("--repeat", type=int, default=20)
+  args = parser.parse_args()
+
+  print(f"{'shape':>12} {'legacy ms':>10} {'single ms':>10} {'speedup':>8}")
+  for size in args.sizes.split(","):
+    num_choices, num_voters = (int(n) for n in size.split("x"))
+    poll = seed_poll(num_choices, num_voters)
+    try:
+      legacy = time_loader(legacy_get_poll, poll.id, args.repeat)
+      # Without clearing the cache only the first call would reach the database
+      single = time_loader(db.get_poll, poll.id, args.repeat, setup=db.poll_cache.clear)
+      print(f"{size:>12} {legacy:>10.2f} {single:>10.2f} {legacy / single:>7.1f}x")
+    finally:
+      db.delete_poll(poll.manage_code)
+
+if __name__ == "__main__":
+  main()
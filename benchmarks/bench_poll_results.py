@@ -0,0 +1,91 @@
+"""Compares the memory and build time of PollResults against per-vote dataclasses.
+
+The previous model built one Vote dataclass per vote, attached them to their
+choices and then derived a (voter_name, choice_id) -> value dict, a set of
+voter names and a dict of managed voters for every rendered poll. This builds
+both representations from the same synthetic loader rows, no database needed:
+
+    python benchmarks/bench_poll_results.py --sizes 10x50,60x400,60x4000
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BASE_URL", "http://localhost:8000")
+
+import db
+import legacy
+
+def synthetic_votes(num_choices: int, num_voters: int) -> tuple[list[str], list[list]]:
+  """Returns choice ids and (choice_id, voter_name, value, manage_code, vote_id) rows ordered by voter name."""
+  choice_ids = [str(uuid.uuid4()) for _ in range(num_choices)]
+  vote_ts = []
+  for v in range(num_voters):
+    manage_code = str(uuid.uuid4())
+    for i, choice_id in enumerate(choice_ids):
+      vote_ts.append([choice_id, f"voter {v:05d}", (v + i) % 2, manage_code, str(uuid.uuid4())])
+  return choice_ids, vote_ts
+
+def build_dataclasses(choice_ids: list[str], vote_ts: list[list], voter_codes: set[str]):
+  votes_by_choice: dict[str, list[legacy.Vote]] = {choice_id: [] for choice_id in choice_ids}
+  for choice_id, voter_name, value, manage_code, vote_id in vote_ts:
+    votes_by_choice[choice_id].append(legacy.Vote(
+      id=vote_id,
+      poll_id="poll",
+      choice_id=choice_id,
+      voter_name=voter_name,
+      value=value,
+      manage_code=manage_code,
+    ))
+
+  voter_names_set: set[str] = set()
+  selections: dict[tuple[str, str], int] = {}
+  managed_voter_names: dict[str, str] = {}
+  for choice_id, votes in votes_by_choice.items():
+    for vote in votes:
+      selections[(vote.voter_name, choice_id)] = vote.value
+      voter_names_set.add(vote.voter_name)
+      if vote.manage_code in voter_codes:
+        managed_voter_names[vote.voter_name] = vote.manage_code
+
+  return votes_by_choice, selections, sorted(voter_names_set), managed_voter_names
+
+def build_poll_results(choice_ids: list[str], vote_ts: list[list], voter_codes: set[str]):
+  results = db.PollResults.from_votes(choice_ids, (vote_t[:4] for vote_t in vote_ts))
+  return results, results.managed_voter_names(voter_codes)
+
+def measure(build, *args) -> tuple[float, int]:
+  """Returns the build time in milliseconds and the bytes still allocated by the result."""
+  start = time.perf_counter()
+  build(*args)
+  elapsed = (time.perf_counter() - start) * 1000
+
+  tracemalloc.start()
+  result = build(*args)
+  retained, _ = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  del result
+  return elapsed, retained
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--sizes", default="10x50,60x400,60x4000",
+                      help="comma separated CHOICESxVOTERS poll shapes")
+  args = parser.parse_args()
+
+  print(f"{'shape':>10} {'dataclass ms':>13} {'results ms':>11} {'dataclass KiB':>14} {'results KiB':>12}")
+  for size in args.sizes.split(","):
+    num_choices, num_voters = (int(n) for n in size.split("x"))
+    choice_ids, vote_ts = synthetic_votes(num_choices, num_voters)
+    voter_codes = {vote_ts[0][3]} if vote_ts else set()
+
+    old_ms, old_bytes = measure(build_dataclasses, choice_ids, vote_ts, voter_codes)
+    new_ms, new_bytes = measure(build_poll_results, choice_ids, vote_ts, voter_codes)
+    print(f"{size:>10} {old_ms:>13.2f} {new_ms:>11.2f} {old_bytes / 1024:>14.1f} {new_bytes / 1024:>12.1f}")
+
+if __name__ == "__main__":
+  main()
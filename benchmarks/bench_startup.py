@@ -0,0 +1,108 @@
+"""Measures how long a fresh process takes to import the app and serve its first requests.
+
+Every run starts a new interpreter, like a gunicorn worker without preloading,
+and reports the import time, which includes loading the templates, and the
+latency of the first and second request to each path. Runs are made with an
+empty Jinja bytecode cache (cold) and with one filled by a previous run (warm).
+Loading all templates from source and from bytecode is timed separately:
+
+    python benchmarks/bench_startup.py --runs 5 --path / --path /static/styles.css
+
+Requests that need the database, e.g. a poll page, work when it is configured.
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+
+CHILD = """
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+
+client = app.app.test_client()
+result = {"import_ms": (imported - start) * 1000, "requests": {}}
+for path in sys.argv[1:]:
+  timings = []
+  for _ in range(2):
+    request_start = time.perf_counter()
+    response = client.get(path)
+    response.get_data()
+    timings.append((time.perf_counter() - request_start) * 1000)
+  result["requests"][path] = {"status": response.status_code, "first_ms": timings[0], "second_ms": timings[1]}
+
+def load_templates():
+  app.app.jinja_env.cache.clear()
+  load_start = time.perf_counter()
+  app.precompile_templates()
+  return (time.perf_counter() - load_start) * 1000
+
+result["bytecode_load_ms"] = load_templates()
+app.app.jinja_env.bytecode_cache = None
+result["compile_ms"] = load_templates()
+print(json.dumps(result))
+"""
+
+def run_once(paths: list[str], cache_dir: str) -> dict:
+  env = dict(os.environ,
+             JINJA_CACHE_DIR=cache_dir,
+             BACKGROUND_WORKERS="0")
+  env.setdefault("BASE_URL", "http://localhost:8000")
+  env.setdefault("DB_PASSWORD", "")
+  env.setdefault("SECRET_KEY", "bench")
+  output = subprocess.run([sys.executable, "-c", CHILD, *paths],
+                          cwd=ROOT, env=env, check=True,
+                          capture_output=True, text=True).stdout
+  return json.loads(output.strip().splitlines()[-1])
+
+def summarize(label: str, results: list[dict], paths: list[str]) -> dict:
+  summary = {
+    "import_ms": statistics.median(r["import_ms"] for r in results),
+    "compile_ms": statistics.median(r["compile_ms"] for r in results),
+    "bytecode_load_ms": statistics.median(r["bytecode_load_ms"] for r in results),
+    "requests": {},
+  }
+  print(f"{label}: import {summary['import_ms']:.1f} ms, "
+        f"templates from source {summary['compile_ms']:.1f} ms, "
+        f"from bytecode {summary['bytecode_load_ms']:.1f} ms")
+  for path in paths:
+    first = statistics.median(r["requests"][path]["first_ms"] for r in results)
+    second = statistics.median(r["requests"][path]["second_ms"] for r in results)
+    status = results[-1]["requests"][path]["status"]
+    summary["requests"][path] = {"status": status, "first_ms": first, "second_ms": second}
+    print(f"  GET {path} ({status}): first {first:.1f} ms, second {second:.1f} ms")
+  return summary
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--runs", type=int, default=5)
+  parser.add_argument("--path", action="append", dest="paths",
+                      help="path to request, may be repeated (default: /)")
+  parser.add_argument("--json", action="store_true", help="print the medians as JSON")
+  args = parser.parse_args()
+  paths = args.paths or ["/"]
+
+  cold = []
+  for _ in range(args.runs):
+    with tempfile.TemporaryDirectory() as cache_dir:
+      cold.append(run_once(paths, cache_dir))
+
+  with tempfile.TemporaryDirectory() as cache_dir:
+    run_once(paths, cache_dir)
+    warm = [run_once(paths, cache_dir) for _ in range(args.runs)]
+
+  summaries = {
+    "cold": summarize("Empty bytecode cache", cold, paths),
+    "warm": summarize("Filled bytecode cache", warm, paths),
+  }
+  if args.json:
+    print(json.dumps(summaries, indent=2))
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,296 @@
+"""Times the read and write hot paths against the configured database.
+
+Seeds synthetic polls of the given shapes (CHOICESxVOTERS, with a mix of yes,
+no and missing values), then times every operation separately: the loaders
+with and without the poll cache, vote_poll, rendering the poll and manage
+pages and whole requests through the Flask test client. The results are
+printed as JSON so that runs on different commits can be compared:
+
+    python benchmarks/bench_suite.py --shapes 5x10,60x400 --repeat 50 --output before.json
+
+With --load-rps the poll and vote endpoints are driven at a fixed request rate
+instead, in process or against a running server given with --url:
+
+    python benchmarks/bench_suite.py --shapes 20x100 --load-rps 100 --load-seconds 30
+
+Load latencies are measured from the time a request was scheduled, so a server
+that falls behind shows up as growing latencies rather than as a lower rate.
+The seeded polls are deleted afterwards unless --keep is given.
+"""
+from dotenv import load_dotenv
+load_dotenv()
+
+import argparse
+import concurrent.futures
+import datetime
+import json
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.environ.setdefault("BASE_URL", "http://localhost:8000")
+# The benchmark measures requests, not the outbox
+os.environ.setdefault("BACKGROUND_WORKERS", "0")
+
+import psycopg2.extras
+from flask import render_template
+
+import app
+import db
+import fragments
+
+def parse_shape(shape: str) -> tuple[int, int]:
+  num_choices, num_voters = (int(n) for n in shape.split("x"))
+  return num_choices, num_voters
+
+def seed_poll(num_choices: int, num_voters: int, yes: float, missing: float,
+              rng: random.Random) -> db.Poll:
+  """Creates a poll with bulk inserts, the tally triggers keep the counts right."""
+  poll = db.create_poll(f"bench {num_choices}x{num_voters}", "Synthetic benchmark poll",
+                        "bench", None, False)
+  start = datetime.datetime(2030, 1, 1, 8, 0)
+  with db.db.cursor() as (conn, cur):
+    try:
+      psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO choices (poll_id, start_datetime, end_datetime) VALUES %s",
+        [(poll.id, start + datetime.timedelta(hours=i), start + datetime.timedelta(hours=i + 1))
+         for i in range(num_choices)])
+      cur.execute("SELECT id FROM choices WHERE poll_id = %s ORDER BY start_datetime", (poll.id,))
+      choice_ids = [row[0] for row in cur.fetchall()]
+
+      rows = []
+      for v in range(num_voters):
+        voter_name = f"voter {v:06d}"
+        manage_code = str(uuid.uuid4())
+        for choice_id in choice_ids:
+          roll = rng.random()
+          if roll < missing:
+            continue
+          rows.append((poll.id, voter_name, choice_id, 1 if roll < missing + yes else 0, manage_code))
+      psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO votes (poll_id, voter_name, choice_id, value, manage_code) VALUES %s",
+        rows,
+        page_size=1000)
+      conn.commit()
+    except Exception as e:
+      conn.rollback()
+      raise e
+
+  return poll
+
+def summarize(samples: list[float]) -> dict[str, float]:
+  samples = sorted(samples)
+  return {
+    "n": len(samples),
+    "min_ms": samples[0],
+    "median_ms": statistics.median(samples),
+    "p95_ms": samples[min(len(samples) - 1, int(len(samples) * 0.95))],
+    "mean_ms": statistics.fmean(samples),
+    "max_ms": samples[-1],
+  }
+
+def measure(operation, repeat: int, setup=None) -> dict[str, float]:
+  """Times operation() repeat times after one warm up call, setup() runs untimed before each call."""
+  if setup is not None:
+    setup()
+  operation()
+
+  samples = []
+  for _ in range(repeat):
+    if setup is not None:
+      setup()
+    start = time.perf_counter()
+    operation()
+    samples.append((time.perf_counter() - start) * 1000)
+  return summarize(samples)
+
+def bench_shape(shape: str, poll: db.Poll, repeat: int, cache_usable: bool) -> list[dict]:
+  results = []
+
+  def record(name: str, operation, setup=None):
+    stats = measure(operation, repeat, setup)
+    results.append({"shape": shape, "name": name, **stats})
+    print(f"{shape:>10} {name:<32} median {stats['median_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms",
+          file=sys.stderr)
+
+  record("db.get_poll", lambda: db.get_poll(poll.id), setup=db.poll_cache.clear)
+  if cache_usable:
+    record("db.get_poll.cached", lambda: db.get_poll(poll.id))
+  record("db.get_poll_by_code", lambda: db.get_poll_by_code(poll.manage_code),
+         setup=db.poll_cache.clear)
+
+  loaded = db.get_poll(poll.id)
+  now = datetime.datetime.now()
+  with app.app.test_request_context(f"/poll/{poll.id}"):
+    for display_mode in ("table", "list"):
+      def render_poll_page():
+        render_template("poll.html.j2",
+                        **app.poll_page_context(loaded, display_mode, [], None, now))
+      record(f"render.poll.{display_mode}", render_poll_page, setup=fragments.fragment_cache.clear)
+      record(f"render.poll.{display_mode}.fragments_cached", render_poll_page)
+    record("render.manage",
+           lambda: render_template("manage.html.j2", **app.manage_page_context(loaded)))
+
+  client = app.app.test_client()
+  list_client = app.app.test_client()
+  list_client.set_cookie("diddle_display_mode", "list")
+  record("request.poll.table", lambda: client.get(f"/poll/{poll.id}").get_data())
+  record("request.poll.list", lambda: list_client.get(f"/poll/{poll.id}").get_data())
+  record("request.manage", lambda: client.get(f"/manage/{poll.manage_code}").get_data())
+  record("request.api.poll", lambda: client.get(f"/api/poll/{poll.id}").get_data())
+
+  # Writes last, every vote makes the poll a little larger
+  selections = {choice.id: i % 2 for i, choice in enumerate(loaded.choices)}
+  record("db.vote_poll",
+         lambda: db.vote_poll(poll.id, f"bench {uuid.uuid4().hex}", selections))
+  form = {f"choice_{choice.id}": "on" for choice in loaded.choices[::2]}
+  record("request.vote",
+         lambda: client.post(f"/poll/{poll.id}/vote",
+                             data={**form, "voter_name": f"bench {uuid.uuid4().hex}"}).get_data())
+  return results
+
+class NoRedirect(urllib.request.HTTPRedirectHandler):
+  def redirect_request(self, *args, **kwargs):
+    return None
+
+def run_load(polls: list[db.Poll], url: str | None, rps: float, seconds: float,
+             concurrency: int, vote_ratio: float, rng: random.Random) -> dict:
+  """Sends requests at a fixed rate, a vote_ratio share of them are votes."""
+  local = threading.local()
+  opener = urllib.request.build_opener(NoRedirect)
+
+  def send(kind: str, poll: db.Poll) -> int:
+    path = f"/poll/{poll.id}" if kind == "view" else f"/poll/{poll.id}/vote"
+    data = None
+    if kind == "vote":
+      data = {"voter_name": f"load {uuid.uuid4().hex}"}
+      data.update({f"choice_{choice.id}": "on" for choice in poll.choices[::2]})
+
+    if url is None:
+      client = getattr(local, "client", None)
+      if client is None:
+        client = local.client = app.app.test_client()
+      response = client.get(path) if data is None else client.post(path, data=data)
+      response.get_data()
+      return response.status_code
+
+    body = urllib.parse.urlencode(data).encode() if data is not None else None
+    try:
+      with opener.open(url.rstrip("/") + path, data=body, timeout=30) as response:
+        response.read()
+        return response.status
+    except urllib.error.HTTPError as e:
+      return e.code
+
+  def task(kind: str, poll: db.Poll, scheduled: float) -> tuple[str, float, bool]:
+    try:
+      ok = send(kind, poll) < 400
+    except Exception:
+      ok = False
+    return kind, (time.perf_counter() - scheduled) * 1000, ok
+
+  total = int(rps * seconds)
+  futures = []
+  with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+    start = time.perf_counter()
+    for i in range(total):
+      scheduled = start + i / rps
+      delay = scheduled - time.perf_counter()
+      if delay > 0:
+        time.sleep(delay)
+      kind = "vote" if rng.random() < vote_ratio else "view"
+      futures.append(executor.submit(task, kind, rng.choice(polls), scheduled))
+    outcomes = [future.result() for future in futures]
+    elapsed = time.perf_counter() - start
+
+  report = {
+    "target_rps": rps,
+    "achieved_rps": len(outcomes) / elapsed,
+    "seconds": elapsed,
+    "requests": len(outcomes),
+    "errors": sum(1 for _, _, ok in outcomes if not ok),
+    "endpoints": {},
+  }
+  for kind in ("view", "vote"):
+    samples = [latency for k, latency, _ in outcomes if k == kind]
+    if samples:
+      report["endpoints"][kind] = summarize(samples)
+  print(f"load: {report['requests']} requests at {report['achieved_rps']:.1f}/s "
+        f"(target {rps}/s), {report['errors']} errors", file=sys.stderr)
+  for kind, stats in report["endpoints"].items():
+    print(f"  {kind:<5} median {stats['median_ms']:8.2f} ms  p95 {stats['p95_ms']:8.2f} ms",
+          file=sys.stderr)
+  return report
+
+def git_commit() -> str | None:
+  try:
+    return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                          cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+  parser.add_argument("--shapes", default="5x10,20x50,60x400",
+                      help="comma separated CHOICESxVOTERS poll shapes")
+  parser.add_argument("--yes", type=float, default=0.5, help="share of yes values")
+  parser.add_argument("--missing", type=float, default=0.05, help="share of cells without a vote")
+  parser.add_argument("--repeat", type=int, default=30)
+  parser.add_argument("--seed", type=int, default=1, help="random seed for the synthetic data")
+  parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+  parser.add_argument("--keep", action="store_true", help="do not delete the seeded polls")
+  parser.add_argument("--load-rps", type=float, help="run the load mode at this many requests per second")
+  parser.add_argument("--load-seconds", type=float, default=10)
+  parser.add_argument("--load-concurrency", type=int, default=16)
+  parser.add_argument("--vote-ratio", type=float, default=0.1, help="share of load requests that vote")
+  parser.add_argument("--url", help="send load requests to this server instead of the test client")
+  args = parser.parse_args()
+
+  rng = random.Random(args.seed)
+  cache_usable = db.listener.wait_connected(5)
+
+  shapes = args.shapes.split(",")
+  polls = [seed_poll(*parse_shape(shape), args.yes, args.missing, rng) for shape in shapes]
+  report = {
+    "meta": {
+      "commit": git_commit(),
+      "python": platform.python_version(),
+      "time": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+      "poll_cache": cache_usable,
+      "args": vars(args),
+    },
+  }
+  try:
+    if args.load_rps:
+      loaded = [db.get_poll(poll.id) for poll in polls]
+      report["load"] = run_load(loaded, args.url, args.load_rps, args.load_seconds,
+                                args.load_concurrency, args.vote_ratio, rng)
+    else:
+      report["benchmarks"] = [result for shape, poll in zip(shapes, polls)
+                              for result in bench_shape(shape, poll, args.repeat, cache_usable)]
+  finally:
+    if not args.keep:
+      for poll in polls:
+        db.delete_poll(poll.manage_code)
+
+  output = json.dumps(report, indent=2)
+  if args.output:
+    with open(args.output, "w") as f:
+      f.write(output + "\n")
+  else:
+    print(output)
+
+if __name__ == "__main__":
+  main()
@@ -0,0 +1,37 @@
+"""The per-vote model that the poll loader and PollResults replaced, kept for comparisons.
+
+The application no longer uses any of this, the benchmarks build the old
+representation from it to measure what the new one saves.
+"""
+from dataclasses import dataclass
+
+import db
+
+@dataclass(slots=True)
+class Vote:
+  id: str
+  poll_id: str
+  choice_id: str
+  voter_name: str
+  value: int # 0 or 1
+  manage_code: str
+
+def tuple_to_choice(choice_t: tuple) -> db.Choice:
+  return db.Choice(
+    id=choice_t[0],
+    poll_id=choice_t[1],
+    start_datetime=choice_t[2],
+    end_datetime=choice_t[3],
+    yes_count=choice_t[4],
+    no_count=choice_t[5],
+  )
+
+def tuple_to_vote(vote_t: tuple) -> Vote:
+  return Vote(
+    id=vote_t[0],
+    poll_id=vote_t[1],
+    choice_id=vote_t[2],
+    voter_name=vote_t[3],
+    value=vote_t[4],
+    manage_code=vote_t[5]
+  )
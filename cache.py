@@ -0,0 +1,157 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Generic, Hashable, TypeVar
+
+V = TypeVar("V")
+
+class LruTtlCache(Generic[V]):
+  """A thread-safe LRU cache whose entries also expire after ttl seconds.
+
+  Loaders that may race with invalidations should take a token with
+  begin_load() before reading the source and pass it to put(). The value is
+  then only stored if nothing was invalidated in the meantime, so a value read
+  before a write can never be cached after that write has evicted the key.
+  """
+  def __init__(self, max_entries: int, ttl: float | None = None):
+    self.max_entries = max_entries
+    self.ttl = ttl
+
+    self._lock = threading.Lock()
+    self._entries: OrderedDict[Hashable, tuple[V, float]] = OrderedDict()
+    self._invalidations = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+    self.expirations = 0
+
+  @property
+  def enabled(self) -> bool:
+    return self.max_entries > 0
+
+  def get(self, key: Hashable) -> V | None:
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      value, stored_at = entry
+      if self.ttl is not None and time.monotonic() - stored_at > self.ttl:
+        del self._entries[key]
+        self.expirations += 1
+        self.misses += 1
+        return None
+
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return value
+
+  def begin_load(self) -> int:
+    with self._lock:
+      return self._invalidations
+
+  def put(self, key: Hashable, value: V, token: int | None = None) -> bool:
+    """Stores the value, returns False if it was dropped because of a newer invalidation."""
+    if not self.enabled:
+      return False
+
+    with self._lock:
+      if token is not None and token != self._invalidations:
+        return False
+
+      self._entries[key] = (value, time.monotonic())
+      self._entries.move_to_end(key)
+      while len(self._entries) > self.max_entries:
+        self._entries.popitem(last=False)
+        self.evictions += 1
+      return True
+
+  def invalidate(self, key: Hashable) -> None:
+    with self._lock:
+      self._invalidations += 1
+      self._entries.pop(key, None)
+
+  def clear(self) -> None:
+    with self._lock:
+      self._invalidations += 1
+      self._entries.clear()
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {
+        "entries": len(self._entries),
+        "max_entries": self.max_entries,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+        "expirations": self.expirations,
+        "invalidations": self._invalidations,
+      }
+
+class SizedLruCache(Generic[V]):
+  """A thread-safe LRU cache bounded by the total size of its values.
+
+  Sizes are given by the caller on put(), values larger than max_size are not
+  stored at all.
+  """
+  def __init__(self, max_size: int):
+    self.max_size = max_size
+
+    self._lock = threading.Lock()
+    self._entries: OrderedDict[Hashable, tuple[V, int]] = OrderedDict()
+    self._size = 0
+
+    self.hits = 0
+    self.misses = 0
+    self.evictions = 0
+
+  @property
+  def enabled(self) -> bool:
+    return self.max_size > 0
+
+  def get(self, key: Hashable) -> V | None:
+    with self._lock:
+      entry = self._entries.get(key)
+      if entry is None:
+        self.misses += 1
+        return None
+
+      self._entries.move_to_end(key)
+      self.hits += 1
+      return entry[0]
+
+  def put(self, key: Hashable, value: V, size: int) -> bool:
+    """Stores the value, returns False if it does not fit in the cache."""
+    if size > self.max_size:
+      return False
+
+    with self._lock:
+      previous = self._entries.pop(key, None)
+      if previous is not None:
+        self._size -= previous[1]
+
+      self._entries[key] = (value, size)
+      self._size += size
+      while self._size > self.max_size:
+        _, (_, evicted_size) = self._entries.popitem(last=False)
+        self._size -= evicted_size
+        self.evictions += 1
+      return True
+
+  def clear(self) -> None:
+    with self._lock:
+      self._entries.clear()
+      self._size = 0
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {
+        "entries": len(self._entries),
+        "size": self._size,
+        "max_size": self.max_size,
+        "hits": self.hits,
+        "misses": self.misses,
+        "evictions": self.evictions,
+      }
@@ -0,0 +1,143 @@
+"""The manage codes of created polls and of votes, kept in one signed cookie.
+
+Every code takes 17 bytes, a kind byte and the 16 bytes of the UUID, and the
+whole jar is base64 encoded and signed. Codes are kept in least recently used
+order, when the cookie would grow past CODE_COOKIE_MAX_BYTES the least
+recently used ones are dropped.
+
+Earlier versions set one cookie per code, diddle_manage_code_<code> and
+diddle_voter_code_<code>. Those are read into the jar and expired.
+"""
+import base64
+import binascii
+import hashlib
+import os
+import secrets
+import sys
+import uuid
+from typing import Iterable, Literal
+
+from itsdangerous import BadSignature, Signer
+
+Kind = Literal["manage", "voter"]
+
+COOKIE_NAME = "diddle_codes"
+CODE_COOKIE_MAX_BYTES = int(os.getenv("CODE_COOKIE_MAX_BYTES", "2048"))
+
+LEGACY_PREFIXES: dict[str, Kind] = {
+  "diddle_manage_code_": "manage",
+  "diddle_voter_code_": "voter",
+}
+
+_FORMAT_VERSION = b"\x01"
+_KIND_BYTES: dict[Kind, bytes] = {"manage": b"m", "voter": b"v"}
+_KINDS: dict[int, Kind] = {value[0]: kind for kind, value in _KIND_BYTES.items()}
+_ENTRY_SIZE = 17
+
+def _secret_key() -> str:
+  secret = os.getenv("SECRET_KEY")
+  if secret:
+    return secret
+  if os.getenv("FLASK_DEBUG", "false").lower() not in ["true", "1", "yes"]:
+    raise Exception("SECRET_KEY must be set, it signs the cookie that grants access to polls and votes")
+  # Only good for a single development process, cookies do not survive a restart
+  print("SECRET_KEY is not set, signing cookies with a random key", file=sys.stderr)
+  return secrets.token_hex(32)
+
+_signer = Signer(_secret_key(), salt="diddle-codes", digest_method=hashlib.sha256)
+
+def _normalize(code: str) -> str | None:
+  """The canonical form of a code, None if it is not a UUID."""
+  try:
+    return str(uuid.UUID(code))
+  except ValueError:
+    return None
+
+class CodeJar:
+  def __init__(self, entries: Iterable[tuple[Kind, str]] = ()):
+    # (kind, code) -> None, least recently used first
+    self._entries: dict[tuple[Kind, str], None] = dict.fromkeys(entries)
+    self.changed = False
+    self.legacy_cookies: list[str] = []
+
+  @classmethod
+  def from_cookies(cls, cookies: dict[str, str]) -> "CodeJar":
+    """Reads the jar cookie and merges in the cookies of earlier versions."""
+    jar = cls(_decode(cookies.get(COOKIE_NAME)))
+    for name in cookies:
+      for prefix, kind in LEGACY_PREFIXES.items():
+        if name.startswith(prefix):
+          jar.legacy_cookies.append(name)
+          code = _normalize(name[len(prefix):])
+          if code is not None and (kind, code) not in jar._entries:
+            # Older than anything already in the jar
+            jar._entries = {(kind, code): None, **jar._entries}
+            jar.changed = True
+    return jar
+
+  def codes(self, kind: Kind) -> set[str]:
+    return {code for entry_kind, code in self._entries if entry_kind == kind}
+
+  def add(self, kind: Kind, code: str) -> None:
+    """Adds a code or marks it as most recently used."""
+    code = _normalize(code)
+    if code is None:
+      return
+    entry = (kind, code)
+    if entry in self._entries:
+      if next(reversed(self._entries)) == entry:
+        return
+      del self._entries[entry]
+    self._entries[entry] = None
+    self.changed = True
+
+  def touch(self, kind: Kind, codes: Iterable[str]) -> None:
+    """Marks codes as most recently used, keeping their order among themselves.
+
+    Nothing changes when they already are the most recently used codes, so
+    viewing the same poll again does not rewrite the cookie.
+    """
+    touched = {(kind, code) for code in map(_normalize, codes) if code is not None}
+    if not touched:
+      return
+    entries = list(self._entries)
+    if set(entries[-len(touched):]) == touched:
+      return
+    self._entries = dict.fromkeys([entry for entry in entries if entry not in touched]
+                                  + [entry for entry in entries if entry in touched]
+                                  + sorted(touched.difference(entries)))
+    self.changed = True
+
+  def remove(self, kind: Kind, code: str) -> None:
+    entry = (kind, _normalize(code))
+    if entry in self._entries:
+      del self._entries[entry]
+      self.changed = True
+
+  def dumps(self, max_bytes: int = CODE_COOKIE_MAX_BYTES) -> str:
+    """The signed cookie value, without the least recently used codes that do not fit."""
+    entries = [_KIND_BYTES[kind] + uuid.UUID(code).bytes for kind, code in self._entries]
+    while True:
+      payload = base64.urlsafe_b64encode(_FORMAT_VERSION + b"".join(entries)).rstrip(b"=")
+      value = _signer.sign(payload).decode()
+      if len(value) <= max_bytes or not entries:
+        return value
+      entries = entries[1:]
+
+def _decode(value: str | None) -> list[tuple[Kind, str]]:
+  if not value:
+    return []
+  try:
+    payload = _signer.unsign(value)
+    data = base64.urlsafe_b64decode(payload + b"=" * (-len(payload) % 4))
+  except (BadSignature, binascii.Error, ValueError):
+    return []
+  if data[:1] != _FORMAT_VERSION or (len(data) - 1) % _ENTRY_SIZE != 0:
+    return []
+
+  entries: list[tuple[Kind, str]] = []
+  for start in range(1, len(data), _ENTRY_SIZE):
+    kind = _KINDS.get(data[start])
+    if kind is not None:
+      entries.append((kind, str(uuid.UUID(bytes=data[start + 1:start + _ENTRY_SIZE]))))
+  return entries
@@ -0,0 +1,50 @@
+import hashlib
+import os
+import time
+
+from flask_compress import Compress
+
+import metrics
+from cache import SizedLruCache
+
+# Bytes of compressed responses kept per process, 0 disables the cache
+COMPRESS_CACHE_SIZE = int(os.getenv("COMPRESS_CACHE_SIZE", str(8 * 1024 * 1024)))
+
+class CachingCompress(Compress):
+  """Flask-Compress that compresses every distinct response body only once.
+
+  Compressed bodies are cached by encoding and a hash of the uncompressed
+  body. Hashing is much cheaper than compressing, so pages that are often
+  identical, like the front page without any polls, skip the compression.
+  """
+  def __init__(self, app=None, max_size: int = COMPRESS_CACHE_SIZE):
+    self.compressed_cache: SizedLruCache[bytes] = SizedLruCache(max_size=max_size)
+    super().__init__(app)
+
+  def after_request(self, response):
+    # Streamed pages compress themselves if they can, compressing them here
+    # would buffer the whole stream
+    if getattr(response, "skip_compression", False):
+      return response
+    return super().after_request(response)
+
+  def compress(self, app, response, algorithm):
+    start = time.perf_counter()
+    try:
+      return self._compress(app, response, algorithm)
+    finally:
+      metrics.record_compress(time.perf_counter() - start)
+
+  def _compress(self, app, response, algorithm):
+    if not self.compressed_cache.enabled:
+      return super().compress(app, response, algorithm)
+
+    key = (algorithm, hashlib.sha1(response.get_data()).digest())
+    compressed = self.compressed_cache.get(key)
+    if compressed is None:
+      compressed = super().compress(app, response, algorithm)
+      self.compressed_cache.put(key, compressed, len(compressed))
+    return compressed
+
+  def stats(self) -> dict[str, int]:
+    return self.compressed_cache.stats()
@@ -1,70 +1,376 @@
 import os
-from typing import Literal
+import select
+import sys
+import traceback
+from typing import Any, Callable, Collection, Iterable, Iterator, Literal, NamedTuple, Sequence
 from dataclasses import dataclass
+import array
 import datetime
+import json
+import threading
+import time
 import psycopg2
+import psycopg2.errors
+import psycopg2.extensions
+import psycopg2.extras
 import uuid
 
+import metrics
+from cache import LruTtlCache
+from notifications import NotifyListener
+
 BASE_URL = os.environ["BASE_URL"]
 
+# Queries that take at least this many seconds are logged with the shape of
+# their parameters, 0 disables the log
+SLOW_QUERY_SECONDS = float(os.getenv("SLOW_QUERY_SECONDS", "0.5"))
+# Also log the plan of slow queries, costs an EXPLAIN per slow query
+SLOW_QUERY_EXPLAIN = os.getenv("SLOW_QUERY_EXPLAIN", "false").lower() in ["true", "1", "yes"]
+
+# Warn when a request runs more queries than this or the same statement more
+# than QUERY_WARN_REPEATS times, 0 disables the warning. On by default in
+# debug mode, to catch query regressions in development and tests.
+_debug = os.getenv("FLASK_DEBUG", "false").lower() in ["true", "1", "yes"]
+QUERY_WARN_COUNT = int(os.getenv("QUERY_WARN_COUNT", "20" if _debug else "0"))
+QUERY_WARN_REPEATS = int(os.getenv("QUERY_WARN_REPEATS", "3" if _debug else "0"))
+
+# Statements that are repeated on purpose, once per page of results
+_paged_statements: set[str] = set()
+
+def _statement_text(query) -> str:
+  if isinstance(query, bytes):
+    query = query.decode(errors="replace")
+  return " ".join(str(query).split())
+
+def _shorten(text: str, length: int = 200) -> str:
+  return text if len(text) <= length else text[:length] + "..."
+
+def _value_shape(value) -> str:
+  if isinstance(value, (list, tuple)):
+    return f"{type(value).__name__}[{len(value)}]"
+  return type(value).__name__
+
+def params_shape(vars) -> str:
+  """Describes query parameters without their values, which may be personal data."""
+  if vars is None:
+    return "none"
+  if isinstance(vars, dict):
+    return "{" + ", ".join(f"{key}: {_value_shape(value)}" for key, value in vars.items()) + "}"
+  return "(" + ", ".join(_value_shape(value) for value in vars) + ")"
+
+class TimedCursor(psycopg2.extensions.cursor):
+  """A cursor that adds its queries to the timings of the current request and logs slow ones."""
+  def execute(self, query, vars=None):
+    start = time.perf_counter()
+    try:
+      result = super().execute(query, vars)
+    finally:
+      elapsed = time.perf_counter() - start
+      metrics.record_query(elapsed, query)
+    if 0 < SLOW_QUERY_SECONDS <= elapsed:
+      self._log_slow_query(query, params_shape(vars), elapsed, vars)
+    return result
+
+  def executemany(self, query, vars_list):
+    vars_list = list(vars_list)
+    start = time.perf_counter()
+    try:
+      result = super().executemany(query, vars_list)
+    finally:
+      elapsed = time.perf_counter() - start
+      metrics.record_query(elapsed, query)
+    if 0 < SLOW_QUERY_SECONDS <= elapsed:
+      shape = f"{len(vars_list)} x {params_shape(vars_list[0]) if vars_list else 'none'}"
+      self._log_slow_query(query, shape, elapsed, vars_list[0] if vars_list else None)
+    return result
+
+  def _log_slow_query(self, query, shape: str, elapsed: float, vars) -> None:
+    metrics.registry.inc("diddle_db_slow_queries_total", {})
+    message = f"Slow query ({elapsed * 1000:.0f} ms, params {shape}): {_shorten(_statement_text(query))}"
+    if SLOW_QUERY_EXPLAIN:
+      plan = self._explain(query, vars)
+      if plan:
+        message += "\n  " + "\n  ".join(plan)
+    print(message, file=sys.stderr)
+
+  def _explain(self, query, vars) -> list[str]:
+    """The plan of query, without running it again. Only plain DML can be explained."""
+    text = _statement_text(query)
+    if text.split(" ", 1)[0].upper() not in ("SELECT", "WITH", "INSERT", "UPDATE", "DELETE"):
+      return []
+    prefix = b"EXPLAIN " if isinstance(query, bytes) else "EXPLAIN "
+    # A separate plain cursor keeps this cursor's results and the request's
+    # query count intact. The savepoint keeps a failed EXPLAIN from aborting
+    # the caller's transaction.
+    in_transaction = not self.connection.autocommit
+    with self.connection.cursor() as cur:
+      try:
+        if in_transaction:
+          cur.execute("SAVEPOINT explain_slow_query")
+        cur.execute(prefix + query, vars)
+        plan = [row[0] for row in cur.fetchall()]
+        if in_transaction:
+          cur.execute("RELEASE SAVEPOINT explain_slow_query")
+        return plan
+      except psycopg2.Error as e:
+        if in_transaction:
+          cur.execute("ROLLBACK TO SAVEPOINT explain_slow_query")
+        return [f"(no plan: {str(e).strip()})"]
+
+def check_query_counts(timings: metrics.RequestTimings, context: str) -> None:
+  """Warns about too many queries or repeated statements in one request, see QUERY_WARN_COUNT."""
+  if QUERY_WARN_COUNT > 0 and timings.db_queries > QUERY_WARN_COUNT:
+    print(f"{context} ran {timings.db_queries} queries, more than {QUERY_WARN_COUNT}",
+          file=sys.stderr)
+  if QUERY_WARN_REPEATS > 0:
+    for statement, count in timings.db_statements.items():
+      if count > QUERY_WARN_REPEATS and statement not in _paged_statements:
+        print(f"{context} ran the same statement {count} times, possibly once per row: "
+              f"{_shorten(_statement_text(statement))}", file=sys.stderr)
+
 class DbContextManager:
   def __init__(self, db: "Db"):
     self.db = db
+    self.conn = None
+    self.cursor = None
 
   def __enter__(self):
-    self.cursor = self.db.get_cursor()
-    return (self.db.conn, self.cursor)
+    self.conn = self.db.checkout()
+    try:
+      self.cursor = self.conn.cursor(cursor_factory=TimedCursor)
+    except psycopg2.Error:
+      self.db.checkin(self.conn, broken=True)
+      raise
+    return (self.conn, self.cursor)
 
   def __exit__(self, exc_type, exc_val, exc_tb):
+    broken = exc_type is not None and issubclass(exc_type, CONNECTION_ERRORS)
     if self.cursor:
-      self.cursor.close()
+      try:
+        self.cursor.close()
+      except psycopg2.Error:
+        broken = True
+    self.db.checkin(self.conn, broken=broken)
     # Return False to propagate exceptions, True to suppress them
     return False
 
+# Errors after which a connection can no longer be trusted and is discarded
+# instead of being returned to the pool.
+CONNECTION_ERRORS = (psycopg2.OperationalError, psycopg2.InterfaceError)
+
 class Db:
+  """A thread-safe pool of connections handed out by cursor().
+
+  Connections are opened lazily. Every checkout validates the connection
+  with a round trip and replaces it transparently if the server has dropped
+  it, e.g. after a database restart. A validate_after above 0 skips the round
+  trip for connections used within that many seconds, they are then only
+  checked for a server that has already closed them. Idle connections above
+  min_size are closed after max_idle seconds. At most
+  max_size connections are open at any time, further checkouts wait for a
+  connection to be returned.
+
+  A forked child starts with an empty pool, connections are never shared with
+  the parent process, e.g. when gunicorn preloads the app.
+  """
   MAX_RETRIES = 5
+  RETRY_BACKOFF_SECONDS = 0.2
+
+  def __init__(self,
+               min_size: int = 1,
+               max_size: int = 10,
+               timeout: float = 30.0,
+               validate_after: float = 0.0,
+               max_idle: float = 300.0):
+    if min_size < 0 or max_size < 1 or min_size > max_size:
+      raise Exception(f"Invalid database pool size: min {min_size}, max {max_size}")
 
-  def __init__(self):
-    self.connect()
+    self.min_size = min_size
+    self.max_size = max_size
+    self.timeout = timeout
+    self.validate_after = validate_after
+    self.max_idle = max_idle
+
+    self._inherited: list[Any] = []
+    self._reset()
+    os.register_at_fork(after_in_child=self._after_fork)
+
+  def _reset(self) -> None:
+    self._lock = threading.Lock()
+    self._slots = threading.BoundedSemaphore(self.max_size)
+    # (connection, time it was returned to the pool), most recently used last
+    self._idle: list[tuple[Any, float]] = []
+    self._size = 0
+    self._opened = False
+
+    self._checkouts = 0
+    self._waits = 0
+    self._reconnects = 0
+    self._discarded = 0
+
+  def _after_fork(self) -> None:
+    # The inherited connections belong to the parent. They are kept referenced,
+    # closing them, even by garbage collection, would end the parent's sessions.
+    self._inherited.extend(conn for conn, _ in self._idle)
+    self._reset()
 
   def connect(self):
-    self.conn = psycopg2.connect(
+    return psycopg2.connect(
       host=os.getenv('DB_HOST', 'localhost'),
       database=os.getenv('DB_DATABASE', 'postgres'),
       port=os.getenv('DB_PORT', '5432'),
       user=os.getenv('DB_USER', 'postgres'),
       password=os.environ['DB_PASSWORD'])
 
-  def get_cursor(self):
-    for _ in range(self.MAX_RETRIES):
+  def _open_connection(self):
+    for attempt in range(self.MAX_RETRIES):
       try:
-        return self.conn.cursor()
-      except psycopg2.Error:
-        self.connect()
+        conn = self.connect()
+        with self._lock:
+          self._size += 1
+        return conn
+      except psycopg2.OperationalError:
+        time.sleep(self.RETRY_BACKOFF_SECONDS * 2 ** attempt)
 
     raise Exception(f"Failed to connect to database after {Db.MAX_RETRIES} retries.")
 
+  def _close_connection(self, conn) -> None:
+    with self._lock:
+      self._size -= 1
+      self._discarded += 1
+    try:
+      conn.close()
+    except psycopg2.Error:
+      pass
+
+  def _is_healthy(self, conn, idle_since: float) -> bool:
+    if conn.closed:
+      return False
+    try:
+      # An idle connection receives nothing unless the server is shutting it
+      # down or has closed it, e.g. on a restart
+      if select.select([conn], [], [], 0)[0]:
+        return False
+      if time.monotonic() - idle_since < self.validate_after:
+        return True
+      # In autocommit mode the check is a single round trip without BEGIN and ROLLBACK
+      conn.autocommit = True
+      try:
+        with conn.cursor() as cur:
+          cur.execute("SELECT 1")
+      finally:
+        conn.autocommit = False
+      return True
+    except (psycopg2.Error, OSError, ValueError):
+      return False
+
+  def _warm_up(self) -> None:
+    with self._lock:
+      if self._opened:
+        return
+      self._opened = True
+
+    for _ in range(self.min_size):
+      conn = self._open_connection()
+      with self._lock:
+        self._idle.append((conn, time.monotonic()))
+
+  def checkout(self):
+    """Returns a healthy connection. Give it back with checkin()."""
+    self._warm_up()
+
+    if not self._slots.acquire(blocking=False):
+      with self._lock:
+        self._waits += 1
+      if not self._slots.acquire(timeout=self.timeout):
+        raise Exception(f"Timed out after {self.timeout}s waiting for a database connection")
+
+    try:
+      for _ in range(self.MAX_RETRIES):
+        with self._lock:
+          idle = self._idle.pop() if self._idle else None
+
+        if idle is None:
+          conn = self._open_connection()
+        else:
+          conn, idle_since = idle
+          if not self._is_healthy(conn, idle_since):
+            self._close_connection(conn)
+            with self._lock:
+              self._reconnects += 1
+            continue
+
+        with self._lock:
+          self._checkouts += 1
+        return conn
+
+      raise Exception(f"Failed to connect to database after {Db.MAX_RETRIES} retries.")
+    except BaseException:
+      self._slots.release()
+      raise
+
+  def checkin(self, conn, broken: bool = False) -> None:
+    try:
+      if not broken and not conn.closed \
+          and conn.info.transaction_status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+        conn.rollback()
+    except psycopg2.Error:
+      broken = True
+
+    try:
+      if broken or conn.closed:
+        self._close_connection(conn)
+        return
+
+      now = time.monotonic()
+      with self._lock:
+        # Close connections above the minimum size that have not been used for a while
+        expired = [c for c, since in self._idle if now - since > self.max_idle]
+        expired = expired[:max(0, self._size - self.min_size)]
+        self._idle = [(c, since) for c, since in self._idle if c not in expired]
+        self._idle.append((conn, now))
+
+      for c in expired:
+        self._close_connection(c)
+    finally:
+      self._slots.release()
+
   def cursor(self):
     return DbContextManager(db=self)
 
-db = Db()
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {
+        "min_size": self.min_size,
+        "max_size": self.max_size,
+        "size": self._size,
+        "idle": len(self._idle),
+        "in_use": self._size - len(self._idle),
+        "checkouts": self._checkouts,
+        "waits": self._waits,
+        "reconnects": self._reconnects,
+        "discarded": self._discarded,
+      }
 
-@dataclass
-class Vote:
-  id: str
-  poll_id: str
-  choice_id: str
-  voter_name: str
-  value: int # 0 or 1
-  manage_code: str
+db = Db(
+  min_size=int(os.getenv('DB_POOL_MIN_SIZE', '1')),
+  max_size=int(os.getenv('DB_POOL_MAX_SIZE', '10')),
+  timeout=float(os.getenv('DB_POOL_TIMEOUT', '30')),
+  validate_after=float(os.getenv('DB_POOL_VALIDATE_AFTER', '0')),
+  max_idle=float(os.getenv('DB_POOL_MAX_IDLE', '300')),
+)
 
-@dataclass
+def pool_stats() -> dict[str, int]:
+  return db.stats()
+
+@dataclass(slots=True)
 class Choice:
   id: str
   poll_id: str
   start_datetime: datetime.datetime
   end_datetime: datetime.datetime
-  votes: list[Vote]
+  yes_count: int
+  no_count: int
 
   def start_datetime_notz(self):
     return self.start_datetime.replace(tzinfo=None)
@@ -85,8 +391,69 @@ class Choice:
     return self.start_datetime.date() == self.end_datetime.date() \
        and self.start_datetime.time() == self.end_datetime.time()
 
-  def votes_with_value(self, value: int) -> list[Vote]:
-    return [vote for vote in self.votes if vote.value == value]
+class VoterRow(NamedTuple):
+  name: str
+  manage_code: str
+  values: memoryview # one value per choice, PollResults.NO_VOTE if not answered
+
+class PollResults:
+  """The votes of a poll as a voters × choices matrix.
+
+  Voters are stored in name order. Their values live in a single flat byte
+  array, one row of len(choice_ids) values per voter, instead of one object
+  per vote.
+  """
+  __slots__ = ("choice_ids", "voter_names", "manage_codes", "values")
+
+  NO_VOTE = -1
+
+  def __init__(self, choice_ids: list[str]):
+    self.choice_ids = choice_ids
+    self.voter_names: list[str] = []
+    self.manage_codes: list[str] = []
+    self.values = array.array("b")
+
+  @classmethod
+  def from_votes(cls, choice_ids: list[str], vote_ts: Iterable[Sequence]) -> "PollResults":
+    """Builds the matrix from (choice_id, voter_name, value, manage_code) rows ordered by voter name."""
+    results = cls(choice_ids)
+    index_by_choice_id = {choice_id: i for i, choice_id in enumerate(choice_ids)}
+    empty_row = array.array("b", [cls.NO_VOTE]) * len(choice_ids)
+    row_start = -1
+
+    for choice_id, voter_name, value, manage_code in vote_ts:
+      if not results.voter_names or results.voter_names[-1] != voter_name:
+        results.voter_names.append(voter_name)
+        results.manage_codes.append(manage_code)
+        row_start = len(results.values)
+        results.values.extend(empty_row)
+
+      choice_index = index_by_choice_id.get(choice_id)
+      if choice_index is not None:
+        results.values[row_start + choice_index] = value
+
+    return results
+
+  def __len__(self) -> int:
+    return len(self.voter_names)
+
+  def row(self, voter_index: int) -> memoryview:
+    width = len(self.choice_ids)
+    return memoryview(self.values)[voter_index * width:(voter_index + 1) * width]
+
+  def __iter__(self) -> Iterator[VoterRow]:
+    for i, name in enumerate(self.voter_names):
+      yield VoterRow(name, self.manage_codes[i], self.row(i))
+
+  def yes_voters(self, choice_index: int) -> list[str]:
+    width = len(self.choice_ids)
+    return [name for i, name in enumerate(self.voter_names)
+            if self.values[i * width + choice_index] == 1]
+
+  def managed_voter_names(self, voter_codes: Collection[str]) -> dict[str, str]:
+    """Maps the names of the voters whose manage codes are given to those codes."""
+    return {name: code for name, code in zip(self.voter_names, self.manage_codes)
+            if code in voter_codes}
 
 @dataclass
 class Poll:
@@ -97,20 +464,60 @@ class Poll:
   author_name: str
   author_email: str | None
   choices: list[Choice]
+  # None when the poll has more than POLL_RESULTS_MAX_VOTERS voters, their
+  # rows are then paged from the database by voter_rows()
+  results: PollResults | None
   manage_code: str
   is_whole_day: bool
+  version: int
+  updated_at: datetime.datetime
+  voter_count: int = 0
 
   def pub_date_formatted_notz(self):
     date = self.pub_date.replace(tzinfo = None).strftime("%d.%m.%Y")
     time = self.pub_date.replace(tzinfo = None).strftime("%H:%M")
     return f"Created on {date} at {time}"
 
+  def ranked_choices(self) -> list[Choice]:
+    """Choices ordered from most to fewest yes votes, earliest first on ties."""
+    return sorted(self.choices, key=lambda choice: (-choice.yes_count, choice.start_datetime))
+
+  def best_choice_ids(self) -> set[str]:
+    """Ids of the choices with the most yes votes, empty if nobody has voted yes."""
+    most = max((choice.yes_count for choice in self.choices), default=0)
+    if most == 0:
+      return set()
+    return {choice.id for choice in self.choices if choice.yes_count == most}
+
+  def voter_rows(self) -> Iterator[VoterRow]:
+    """The voter rows in name order, values ordered like choices."""
+    if self.results is not None:
+      return iter(self.results)
+    return iter_voter_rows(self.id, [choice.id for choice in self.choices])
+
+  def yes_voters_by_choice(self) -> Iterator[list[str]]:
+    """The names of the voters who voted yes, one list per choice."""
+    if self.results is not None:
+      return (self.results.yes_voters(i) for i in range(len(self.choices)))
+    return iter_yes_voters([choice.id for choice in self.choices])
+
+  def managed_voter_names(self, voter_codes: Collection[str]) -> dict[str, str]:
+    """Maps the names of the voters whose manage codes are given to those codes."""
+    if self.results is not None:
+      return self.results.managed_voter_names(voter_codes)
+    if not voter_codes:
+      return {}
+    return get_managed_voter_names(self.id, voter_codes)
+
   def share_url(self):
     return f"{BASE_URL}/poll/{self.id}"
 
   def manage_url(self):
     return f"{BASE_URL}/manage/{self.manage_code}"
 
+  def stamp(self) -> "PollStamp":
+    return PollStamp(id=self.id, version=self.version, updated_at=self.updated_at)
+
 def tuple_to_poll(poll_t: tuple) -> Poll:
   return Poll(
     id=poll_t[0],
@@ -121,73 +528,357 @@ def tuple_to_poll(poll_t: tuple) -> Poll:
     author_email=poll_t[5],
     manage_code=poll_t[6],
     is_whole_day=poll_t[7],
-    choices=[]
+    version=poll_t[8],
+    updated_at=poll_t[9],
+    choices=[],
+    results=PollResults([])
   )
 
-def tuple_to_choice(choice_t: tuple) -> Choice:
-  return Choice(
-    id=choice_t[0],
-    poll_id=choice_t[1],
-    start_datetime=choice_t[2],
-    end_datetime=choice_t[3],
-    votes=[]
-  )
 
-def tuple_to_vote(vote_t: tuple) -> Vote:
-  return Vote(
-    id=vote_t[0],
-    poll_id=vote_t[1],
-    choice_id=vote_t[2],
-    voter_name=vote_t[3],
-    value=vote_t[4],
-    manage_code=vote_t[5]
-  )
+POLL_COLUMNS = "id, title, description, pub_date, author_name, author_email, manage_code, whole_day, version, updated_at"
+POLL_COLUMN_COUNT = POLL_COLUMNS.count(",") + 1
+
+# Polls with more voters than this are loaded without their votes, pages
+# render their voter rows page by page instead of holding them all in memory
+POLL_RESULTS_MAX_VOTERS = int(os.getenv("POLL_RESULTS_MAX_VOTERS", "1000"))
+VOTER_ROWS_PAGE_SIZE = int(os.getenv("VOTER_ROWS_PAGE_SIZE", "200"))
+YES_VOTERS_PAGE_CHOICES = 10
+
+# Loads a poll with its choices, voter count and votes in a single round trip.
+# Choices and votes are aggregated into JSON arrays so the poll columns are not
+# repeated for every vote row. The votes are NULL for polls with too many voters.
+LOAD_POLL_SQL = (
+  f"SELECT {POLL_COLUMNS}, "
+  "COALESCE((SELECT json_agg(json_build_array(c.id, c.start_datetime, c.end_datetime, c.yes_count, c.no_count) "
+  "                          ORDER BY c.start_datetime, c.id) "
+  "          FROM choices c WHERE c.poll_id = p.id), '[]'), "
+  "voters.count, "
+  f"CASE WHEN voters.count <= {POLL_RESULTS_MAX_VOTERS:d} THEN "
+  "  COALESCE((SELECT json_agg(json_build_array(v.choice_id, v.voter_name, v.value, v.manage_code) "
+  "                            ORDER BY v.voter_name) "
+  "            FROM votes v WHERE v.poll_id = p.id), '[]') "
+  "END "
+  "FROM polls p "
+  "CROSS JOIN LATERAL (SELECT count(DISTINCT v.voter_name) AS count "
+  "                    FROM votes v WHERE v.poll_id = p.id) voters "
+)
+
+def row_to_loaded_poll(row: tuple) -> Poll:
+  """Builds a Poll from a LOAD_POLL_SQL row, collecting the votes into a PollResults in one pass."""
+  poll = tuple_to_poll(row[:POLL_COLUMN_COUNT])
+  choice_ts, poll.voter_count, vote_ts = row[POLL_COLUMN_COUNT:POLL_COLUMN_COUNT + 3]
+
+  for choice_t in choice_ts:
+    poll.choices.append(Choice(
+      id=choice_t[0],
+      poll_id=poll.id,
+      start_datetime=datetime.datetime.fromisoformat(choice_t[1]),
+      end_datetime=datetime.datetime.fromisoformat(choice_t[2]),
+      yes_count=choice_t[3],
+      no_count=choice_t[4],
+    ))
 
-def get_poll(id: str):
+  if vote_ts is not None:
+    poll.results = PollResults.from_votes([choice.id for choice in poll.choices], vote_ts)
+  else:
+    poll.results = None
+  return poll
+
+def _load_poll(where: str, param: str) -> Poll | None:
   with db.cursor() as (conn, cur):
     try:
-      cur.execute("SELECT * FROM polls WHERE id = %s", (id,))
-      poll_t = cur.fetchone()
-      if poll_t is None:
-        return None
+      cur.execute(LOAD_POLL_SQL + where, (param,))
+      row = cur.fetchone()
+      conn.commit()
+      return row_to_loaded_poll(row) if row else None
+    except Exception as e:
+      conn.rollback()
+      raise e
 
-      poll = tuple_to_poll(poll_t)
-      cur.execute("SELECT * FROM choices "
-                  "WHERE poll_id = %s "
-                  "ORDER BY start_datetime", (id,))
-      choice_ts = cur.fetchall()
+VOTER_ROWS_PAGE_SQL = (
+  "WITH page AS ("
+  "  SELECT DISTINCT voter_name FROM votes "
+  "  WHERE poll_id = %(poll_id)s AND (%(after)s::text IS NULL OR voter_name > %(after)s) "
+  "  ORDER BY voter_name LIMIT %(limit)s"
+  ") "
+  "SELECT v.choice_id, v.voter_name, v.value, v.manage_code "
+  "FROM votes v JOIN page USING (voter_name) "
+  "WHERE v.poll_id = %(poll_id)s "
+  "ORDER BY v.voter_name"
+)
+_paged_statements.add(VOTER_ROWS_PAGE_SQL)
+
+def iter_voter_rows(poll_id: str, choice_ids: list[str],
+                    page_size: int = VOTER_ROWS_PAGE_SIZE) -> Iterator[VoterRow]:
+  """Yields the voter rows of a poll in name order, fetching page_size voters per query.
+
+  No connection is held between pages, so this can be consumed slowly by a
+  streamed response. Pages are read in separate transactions and may see
+  later votes than the poll they are rendered with.
+  """
+  after: str | None = None
+  while True:
+    with db.cursor() as (conn, cur):
+      try:
+        cur.execute(VOTER_ROWS_PAGE_SQL,
+                    {"poll_id": poll_id, "after": after, "limit": page_size})
+        vote_ts = cur.fetchall()
+        conn.commit()
+      except Exception as e:
+        conn.rollback()
+        raise e
+
+    page = PollResults.from_votes(choice_ids, vote_ts)
+    yield from page
+    if len(page) < page_size:
+      return
+    after = page.voter_names[-1]
 
-      cur.execute("SELECT * FROM votes "
-                  "WHERE poll_id = %s "
-                  "ORDER BY voter_name", (id,))
-      vote_ts = cur.fetchall()
+YES_VOTERS_PAGE_SQL = (
+  "SELECT choice_id, array_agg(voter_name ORDER BY voter_name) FROM votes "
+  "WHERE choice_id = ANY(%s::uuid[]) AND value = 1 "
+  "GROUP BY choice_id"
+)
+_paged_statements.add(YES_VOTERS_PAGE_SQL)
 
-      for choice_t in choice_ts:
-        choice = tuple_to_choice(choice_t)
+def iter_yes_voters(choice_ids: list[str],
+                    page_choices: int = YES_VOTERS_PAGE_CHOICES) -> Iterator[list[str]]:
+  """Yields the names of the yes voters of each choice in order, fetching a few choices per query."""
+  for start in range(0, len(choice_ids), page_choices):
+    page_ids = choice_ids[start:start + page_choices]
+    with db.cursor() as (conn, cur):
+      try:
+        cur.execute(YES_VOTERS_PAGE_SQL, (page_ids,))
+        names_by_choice_id = dict(cur.fetchall())
+        conn.commit()
+      except Exception as e:
+        conn.rollback()
+        raise e
 
-        for vote_t in vote_ts:
-          vote = tuple_to_vote(vote_t)
-          if vote.choice_id == choice.id:
-            choice.votes.append(vote)
+    for choice_id in page_ids:
+      yield names_by_choice_id.get(choice_id, [])
 
-        poll.choices.append(choice)
+def _is_uuid(s: str) -> bool:
+  try:
+    uuid.UUID(s)
+    return True
+  except ValueError:
+    return False
 
+def get_managed_voter_names(poll_id: str, voter_codes: Collection[str]) -> dict[str, str]:
+  """Maps the names of the poll's voters whose manage codes are given to those codes."""
+  with db.cursor() as (conn, cur):
+    try:
+      cur.execute("SELECT DISTINCT voter_name, manage_code::text FROM votes "
+                  "WHERE poll_id = %s AND manage_code = ANY(%s::uuid[]) "
+                  "ORDER BY voter_name",
+                  (poll_id, [code for code in voter_codes if _is_uuid(code)]))
+      managed = dict(cur.fetchall())
       conn.commit()
-      return poll
+      return managed
     except Exception as e:
       conn.rollback()
       raise e
 
+### Poll cache
+
+# Loaded polls are cached per process by id. Every write bumps polls.version
+# and sends a NOTIFY on this channel in the same transaction, which evicts the
+# poll from the cache of every process once the write has been committed.
+# The notification also describes the change for live page updates:
+#
+#   {"poll_id", "version", "event", "voter_name", "values", "tallies"}
+#
+# where event is "voter" (a voter's row was added or changed, values holds the
+# row), "voter_deleted", "changed" (anything else) or "deleted". values and
+# tallies are ordered like the poll's choices. Changes that do not fit in a
+# notification are sent as a bare "changed" event.
+POLL_CHANGED_CHANNEL = "poll_changed"
+NOTIFY_MAX_PAYLOAD_BYTES = 7900
+
+poll_cache: LruTtlCache[Poll] = LruTtlCache(
+  max_entries=int(os.getenv('POLL_CACHE_SIZE', '256')),
+  ttl=float(os.getenv('POLL_CACHE_TTL', '60')),
+)
+poll_id_by_code: LruTtlCache[str] = LruTtlCache(max_entries=poll_cache.max_entries * 4)
+
+listener = NotifyListener(db.connect)
+
+def _on_poll_changed(payload: str) -> None:
+  poll_cache.invalidate(json.loads(payload)["poll_id"])
+
+listener.subscribe(POLL_CHANGED_CHANNEL, _on_poll_changed)
+# Notifications may have been missed while the listener was disconnected
+listener.on_reset(poll_cache.clear)
+
+def _poll_cache_usable() -> bool:
+  if not poll_cache.enabled:
+    return False
+  listener.ensure_started()
+  # Without a live listener other processes' writes would go unnoticed
+  return listener.connected
+
+def _lock_poll(cur, poll_id: str) -> None:
+  """Takes the poll's row lock, so concurrent writes to the poll queue up behind each other."""
+  cur.execute("SELECT 1 FROM polls WHERE id = %s FOR NO KEY UPDATE", (poll_id,))
+
+def _lock_polls(cur, poll_ids: Collection[str]) -> list[str]:
+  """Takes the row locks of several polls in id order, returns the ids of the polls that exist."""
+  cur.execute("SELECT id FROM polls WHERE id = ANY(%s::uuid[]) ORDER BY id FOR NO KEY UPDATE",
+              (list(poll_ids),))
+  return [row[0] for row in cur.fetchall()]
+
+def _poll_changed(cur,
+                  poll_id: str,
+                  event: Literal["voter", "voter_deleted", "changed"] = "changed",
+                  voter_name: str | None = None) -> None:
+  """Bumps the version of the poll and notifies all processes, call last before commit.
+
+  Every write takes the poll's row lock with _lock_poll before it touches
+  choices or votes, whose tally trigger locks choice rows. Taking the locks in
+  that order keeps concurrent writes to a poll from deadlocking.
+  """
+  cur.execute("WITH bumped AS ("
+              "  UPDATE polls SET version = version + 1, updated_at = CURRENT_TIMESTAMP "
+              "  WHERE id = %(poll_id)s RETURNING id, version"
+              "), message AS ("
+              "  SELECT json_build_object("
+              "    'poll_id', b.id, 'version', b.version, 'event', %(event)s::text, "
+              "    'voter_name', %(voter_name)s::text, "
+              "    'values', CASE WHEN %(event)s::text = 'voter' THEN ("
+              "      SELECT json_agg(v.value ORDER BY c.start_datetime, c.id) "
+              "      FROM choices c "
+              "      LEFT JOIN votes v ON v.choice_id = c.id AND v.voter_name = %(voter_name)s "
+              "      WHERE c.poll_id = b.id) END, "
+              "    'tallies', (SELECT json_agg(c.yes_count ORDER BY c.start_datetime, c.id) "
+              "                FROM choices c WHERE c.poll_id = b.id)"
+              "  )::text AS payload, "
+              "  json_build_object('poll_id', b.id, 'version', b.version, 'event', 'changed')::text AS fallback "
+              "  FROM bumped b"
+              ") "
+              "SELECT pg_notify(%(channel)s, "
+              "                 CASE WHEN octet_length(payload) <= %(max_bytes)s THEN payload ELSE fallback END) "
+              "FROM message",
+              {"poll_id": poll_id, "event": event, "voter_name": voter_name,
+               "channel": POLL_CHANGED_CHANNEL, "max_bytes": NOTIFY_MAX_PAYLOAD_BYTES})
+
+def _poll_deleted(cur, poll_id: str) -> None:
+  """Notifies all processes that the poll is gone, call before commit."""
+  cur.execute("SELECT pg_notify(%s, json_build_object('poll_id', %s::text, 'version', NULL, "
+              "                                           'event', 'deleted')::text)",
+              (POLL_CHANGED_CHANNEL, poll_id))
+
+@dataclass
+class PollStamp:
+  id: str
+  version: int
+  updated_at: datetime.datetime
+
+def _get_poll_stamp(where: str, param: str) -> PollStamp | None:
+  with db.cursor() as (conn, cur):
+    try:
+      cur.execute(f"SELECT id, version, updated_at FROM polls {where}", (param,))
+      row = cur.fetchone()
+      conn.commit()
+      return PollStamp(id=row[0], version=row[1], updated_at=row[2]) if row else None
+    except Exception as e:
+      conn.rollback()
+      raise e
+
+@dataclass
+class PollTitle:
+  id: str
+  title: str
+  manage_code: str
+
+def get_poll_title_by_code(code: str) -> PollTitle | None:
+  """Returns what a confirmation page needs to name a poll, without loading it."""
+  with db.cursor() as (conn, cur):
+    try:
+      cur.execute("SELECT id, title, manage_code FROM polls WHERE manage_code = %s", (code,))
+      row = cur.fetchone()
+      conn.commit()
+      return PollTitle(*row) if row else None
+    except Exception as e:
+      conn.rollback()
+      raise e
+
+def get_poll_stamp(id: str) -> PollStamp | None:
+  """Returns the current version of a poll without loading it."""
+  if _poll_cache_usable():
+    poll = poll_cache.get(id)
+    if poll is not None:
+      return poll.stamp()
+  return _get_poll_stamp("WHERE id = %s", id)
+
+def get_poll_stamp_by_code(code: str) -> PollStamp | None:
+  """Returns the current version of a poll by its manage code without loading it."""
+  if _poll_cache_usable():
+    poll_id = poll_id_by_code.get(code)
+    poll = poll_cache.get(poll_id) if poll_id is not None else None
+    if poll is not None:
+      return poll.stamp()
+  return _get_poll_stamp("WHERE manage_code = %s", code)
+
+def poll_cache_stats() -> dict[str, int]:
+  return poll_cache.stats()
+
+def get_poll(id: str) -> Poll | None:
+  if not _poll_cache_usable():
+    return _load_poll("WHERE p.id = %s", id)
+
+  poll = poll_cache.get(id)
+  if poll is not None:
+    return poll
+
+  token = poll_cache.begin_load()
+  poll = _load_poll("WHERE p.id = %s", id)
+  if poll is not None:
+    poll_cache.put(poll.id, poll, token)
+  return poll
+
+def get_polls(ids: Sequence[str]) -> list[Poll]:
+  """Returns the polls that exist in the order of ids, loading all cache misses in one query."""
+  cache_usable = _poll_cache_usable()
+  found: dict[str, Poll] = {}
+  if cache_usable:
+    for id in ids:
+      poll = poll_cache.get(id)
+      if poll is not None:
+        found[id] = poll
+
+  missing = [id for id in dict.fromkeys(ids) if id not in found]
+  if missing:
+    token = poll_cache.begin_load()
+    with db.cursor() as (conn, cur):
+      try:
+        cur.execute(LOAD_POLL_SQL + "WHERE p.id = ANY(%s::uuid[])", (missing,))
+        rows = cur.fetchall()
+        conn.commit()
+      except Exception as e:
+        conn.rollback()
+        raise e
+
+    for row in rows:
+      poll = row_to_loaded_poll(row)
+      found[poll.id] = poll
+      if cache_usable:
+        poll_cache.put(poll.id, poll, token)
+
+  return [found[id] for id in dict.fromkeys(ids) if id in found]
+
 def create_poll(title: str,
                 description: str | None,
                 author_name: str,
                 author_email: str | None,
-                is_whole_day: bool):
+                is_whole_day: bool,
+                notify: bool = False):
+  """Creates a poll, if notify is set a poll_created task is queued in the outbox."""
 
   with db.cursor() as (conn, cur):
     try:
       cur.execute("INSERT INTO polls (title, description, author_name, author_email, whole_day)"
-                  "VALUES (%s, %s, %s, %s, %s) RETURNING *",
+                  f"VALUES (%s, %s, %s, %s, %s) RETURNING {POLL_COLUMNS}",
                   (title, description, author_name, author_email, is_whole_day))
       poll_t = cur.fetchone()
 
@@ -195,6 +886,8 @@ def create_poll(title: str,
         raise Exception("Failed to create poll")
 
       poll = tuple_to_poll(poll_t)
+      if notify:
+        _enqueue(cur, "poll_created", {"poll_id": poll.id})
 
       conn.commit()
       return poll
@@ -202,17 +895,39 @@ def create_poll(title: str,
       conn.rollback()
       raise e
 
-def vote_poll(poll_id: str, voter_name: str, selections: dict[str, int]) -> str | None:
-  """Returns the manage code of the vote or None if the vote failed on unique constraint."""
+def vote_poll(poll_id: str,
+              voter_name: str,
+              selections: dict[str, int],
+              notify: bool = False,
+              digest_window: float = 0) -> str | None:
+  """Returns the manage code of the vote or None if the vote failed on unique constraint.
+
+  If notify is set a participation task is queued in the outbox. With a
+  digest_window the task is delayed by that many seconds and coalesced with
+  the other participations in the poll into a single digest.
+  """
   with db.cursor() as (conn, cur):
     try:
       manage_code = str(uuid.uuid4())
-      for choice_id in selections:
-        value = selections[choice_id]
-        cur.execute("INSERT INTO votes (poll_id, voter_name, choice_id, value, manage_code)"
-                    "VALUES (%s, %s, %s, %s, %s)",
-                    (poll_id, voter_name, choice_id, value, manage_code))
+      # Lock the poll first, so concurrent votes do not contend on the tally rows
+      _lock_poll(cur, poll_id)
+      rows = [(poll_id, voter_name, choice_id, value, manage_code)
+              for choice_id, value in selections.items()]
+      # A single multi-row INSERT, page_size keeps execute_values from splitting it
+      psycopg2.extras.execute_values(
+        cur,
+        "INSERT INTO votes (poll_id, voter_name, choice_id, value, manage_code) VALUES %s",
+        rows,
+        template="(%s, %s, %s, %s, %s)",
+        page_size=max(len(rows), 1))
+      _poll_changed(cur, poll_id, "voter", voter_name)
+      if notify and digest_window > 0:
+        _enqueue(cur, "participation_digest", {"poll_id": poll_id, "voter_name": voter_name},
+                 delay=digest_window, coalesce_key=f"participation_digest:{poll_id}")
+      elif notify:
+        _enqueue(cur, "participation", {"poll_id": poll_id, "voter_name": voter_name})
       conn.commit()
+      poll_cache.invalidate(poll_id)
       return manage_code
     except psycopg2.errors.UniqueViolation:
       conn.rollback()
@@ -221,21 +936,94 @@ def vote_poll(poll_id: str, voter_name: str, selections: dict[str, int]) -> str
       conn.rollback()
       raise e
 
-def get_poll_by_code(code: str) -> Poll | None:
+@dataclass
+class VoterVotes:
+  name: str
+  manage_code: str
+  values: dict[str, int] # choice id -> value, missing if not answered
+
+def get_voter_votes(poll_id: str, voter_manage_code: str) -> VoterVotes | None:
+  """Returns the values of one voter in a poll, for editing them."""
   with db.cursor() as (conn, cur):
     try:
-      cur.execute("SELECT id FROM polls WHERE manage_code = %s", (code,))
-      poll_t = cur.fetchone()
-      if poll_t is None:
+      cur.execute("SELECT voter_name, choice_id, value FROM votes "
+                  "WHERE manage_code = %s AND poll_id = %s",
+                  (voter_manage_code, poll_id))
+      rows = cur.fetchall()
+      conn.commit()
+      if not rows:
         return None
+      return VoterVotes(name=rows[0][0],
+                        manage_code=voter_manage_code,
+                        values={choice_id: value for _, choice_id, value in rows})
+    except Exception as e:
+      conn.rollback()
+      raise e
+
+def update_votes(poll_id: str, voter_manage_code: str, changes: dict[str, int]) -> str | None:
+  """Changes some values of an existing vote, returns the voter's name or None if there is no such vote.
 
-      poll = get_poll(poll_t[0])
+  Only the rows of changed values are written, by one UPDATE keyed by manage
+  code and choice id. Choices added after the vote have no row yet, those
+  are inserted by the same statement.
+  """
+  with db.cursor() as (conn, cur):
+    try:
+      _lock_poll(cur, poll_id)
+      cur.execute("WITH voter AS ("
+                  "  SELECT poll_id, voter_name FROM votes "
+                  "  WHERE manage_code = %(code)s AND poll_id = %(poll_id)s LIMIT 1"
+                  "), changes AS ("
+                  "  SELECT * FROM unnest(%(choice_ids)s::uuid[], %(values)s::integer[]) AS c(choice_id, value)"
+                  "), updated AS ("
+                  "  UPDATE votes v SET value = c.value FROM changes c "
+                  "  WHERE v.manage_code = %(code)s AND v.poll_id = %(poll_id)s "
+                  "    AND v.choice_id = c.choice_id AND v.value IS DISTINCT FROM c.value "
+                  "  RETURNING v.id"
+                  "), added AS ("
+                  "  INSERT INTO votes (poll_id, voter_name, choice_id, value, manage_code) "
+                  "  SELECT voter.poll_id, voter.voter_name, c.choice_id, c.value, %(code)s::uuid "
+                  "  FROM voter, changes c JOIN choices ch ON ch.id = c.choice_id "
+                  "  WHERE ch.poll_id = voter.poll_id "
+                  "    AND NOT EXISTS (SELECT 1 FROM votes v "
+                  "                    WHERE v.manage_code = %(code)s AND v.choice_id = c.choice_id) "
+                  "  RETURNING id"
+                  ") "
+                  "SELECT voter_name, (SELECT count(*) FROM updated) + (SELECT count(*) FROM added) "
+                  "FROM voter",
+                  {"code": voter_manage_code, "poll_id": poll_id,
+                   "choice_ids": list(changes), "values": list(changes.values())})
+      row = cur.fetchone()
+      if row is None:
+        conn.rollback()
+        return None
+
+      voter_name, written = row
+      if written > 0:
+        _poll_changed(cur, poll_id, "voter", voter_name)
       conn.commit()
-      return poll
+      if written > 0:
+        poll_cache.invalidate(poll_id)
+      return voter_name
     except Exception as e:
       conn.rollback()
       raise e
 
+def get_poll_by_code(code: str) -> Poll | None:
+  if not _poll_cache_usable():
+    return _load_poll("WHERE p.manage_code = %s", code)
+
+  poll_id = poll_id_by_code.get(code)
+  if poll_id is not None:
+    return get_poll(poll_id)
+
+  token = poll_cache.begin_load()
+  poll = _load_poll("WHERE p.manage_code = %s", code)
+  if poll is not None:
+    poll_id_by_code.put(code, poll.id)
+    poll_cache.put(poll.id, poll, token)
+  return poll
+
 def update_poll_info(
     code: str,
     title: str,
@@ -252,38 +1040,84 @@ def update_poll_info(
                   "RETURNING id",
                   (title, description, author_name, author_email, is_whole_day, code))
       changed = cur.fetchone()
+      if changed:
+        _poll_changed(cur, changed[0])
       conn.commit()
+      if changed:
+        poll_cache.invalidate(changed[0])
       return changed[0] if changed else None
     except Exception as e:
       conn.rollback()
       raise e
 
-def add_choice_to_poll(
-    code,
-    start_datetime,
-    end_datetime,
-  ) -> None:
-  poll = get_poll_by_code(code)
-  if poll is None:
-    raise Exception(f"Poll not found for code: {code}")
+def add_choices_to_poll(
+    code: str,
+    ranges: Sequence[tuple[datetime.datetime | str, datetime.datetime | str]],
+  ) -> int | None:
+  """Adds choices with the given (start, end) datetimes to the poll with the manage code.
 
+  One statement checks the manage code and inserts all choices, ranges the
+  poll already has are skipped. Returns the number of choices added, None if
+  there is no poll with the manage code.
+  """
   with db.cursor() as (conn, cur):
     try:
-      cur.execute("INSERT INTO choices (poll_id, start_datetime, end_datetime)"
-                  "VALUES (%s, %s, %s) "
-                  "RETURNING id",
-                  (poll.id, start_datetime, end_datetime))
+      cur.execute("WITH poll AS ("
+                  "  SELECT id FROM polls WHERE manage_code = %(code)s FOR NO KEY UPDATE"
+                  "), added AS ("
+                  "  INSERT INTO choices (poll_id, start_datetime, end_datetime) "
+                  "  SELECT DISTINCT poll.id, r.start_datetime, r.end_datetime "
+                  "  FROM poll, unnest(%(starts)s::timestamp[], %(ends)s::timestamp[]) "
+                  "    AS r(start_datetime, end_datetime) "
+                  "  WHERE NOT EXISTS (SELECT 1 FROM choices c "
+                  "                    WHERE c.poll_id = poll.id "
+                  "                      AND c.start_datetime = r.start_datetime "
+                  "                      AND c.end_datetime = r.end_datetime) "
+                  "  RETURNING id"
+                  ") "
+                  "SELECT poll.id, (SELECT count(*) FROM added) FROM poll",
+                  {"code": code,
+                   "starts": [start for start, _ in ranges],
+                   "ends": [end for _, end in ranges]})
+      row = cur.fetchone()
+      if row is None:
+        conn.rollback()
+        return None
+
+      poll_id, added = row
+      if added > 0:
+        _poll_changed(cur, poll_id)
       conn.commit()
+      if added > 0:
+        poll_cache.invalidate(poll_id)
+      return added
     except Exception as e:
       conn.rollback()
       raise e
 
-def delete_choice(choice_id: str) -> None:
+def delete_choice(code: str, choice_id: str) -> bool:
+  """Deletes a choice of the poll with the manage code, its votes cascade.
+
+  One statement checks the manage code and deletes the choice. Returns False
+  if there is no such choice in that poll.
+  """
   with db.cursor() as (conn, cur):
     try:
-      cur.execute("DELETE FROM choices WHERE id = %s", (choice_id,))
-      cur.execute("DELETE FROM votes WHERE choice_id = %s", (choice_id,))
+      # The poll is locked by the join, before the cascading votes update the tallies
+      cur.execute("WITH poll AS ("
+                  "  SELECT id FROM polls WHERE manage_code = %s FOR NO KEY UPDATE"
+                  ") "
+                  "DELETE FROM choices c USING poll "
+                  "WHERE c.id = %s AND c.poll_id = poll.id "
+                  "RETURNING c.poll_id",
+                  (code, choice_id))
+      deleted = cur.fetchone()
+      if deleted:
+        _poll_changed(cur, deleted[0])
       conn.commit()
+      if deleted:
+        poll_cache.invalidate(deleted[0])
+      return deleted is not None
     except Exception as e:
       conn.rollback()
       raise e
@@ -292,7 +1126,7 @@ def get_polls_by_codes(codes: list[str]) -> list[Poll]:
   with db.cursor() as (conn, cur):
     try:
       codes_t = tuple(codes)
-      cur.execute("SELECT * FROM polls "
+      cur.execute(f"SELECT {POLL_COLUMNS} FROM polls "
                   "WHERE manage_code IN %s "
                   "ORDER BY pub_date DESC", (codes_t,))
       poll_ts = cur.fetchall()
@@ -307,8 +1141,13 @@ def get_polls_by_codes(codes: list[str]) -> list[Poll]:
 def delete_poll(code: str) -> None:
   with db.cursor() as (conn, cur):
     try:
-      cur.execute("DELETE FROM polls WHERE manage_code = %s", (code,))
+      cur.execute("DELETE FROM polls WHERE manage_code = %s RETURNING id", (code,))
+      deleted = cur.fetchone()
+      if deleted:
+        _poll_deleted(cur, deleted[0])
       conn.commit()
+      if deleted:
+        poll_cache.invalidate(deleted[0])
     except Exception as e:
       conn.rollback()
       raise e
@@ -327,38 +1166,303 @@ def get_voter_name_by_manage_code(voter_manage_code: str) -> str | None:
 def delete_voter(voter_manage_code: str) -> None:
   with db.cursor() as (conn, cur):
     try:
-      cur.execute("DELETE FROM votes WHERE manage_code = %s", (voter_manage_code,))
+      cur.execute("SELECT DISTINCT poll_id FROM votes WHERE manage_code = %s", (voter_manage_code,))
+      _lock_polls(cur, [row[0] for row in cur.fetchall()])
+      cur.execute("DELETE FROM votes WHERE manage_code = %s RETURNING poll_id, voter_name", (voter_manage_code,))
+      deleted = set(cur.fetchall())
+      for poll_id, voter_name in deleted:
+        _poll_changed(cur, poll_id, "voter_deleted", voter_name)
+      poll_ids = {poll_id for poll_id, _ in deleted}
       conn.commit()
+      for poll_id in poll_ids:
+        poll_cache.invalidate(poll_id)
     except Exception as e:
       conn.rollback()
       raise e
 
-### Migrations
+TALLIES_SQL = (
+  "SELECT c.id, c.poll_id, "
+  "       count(v.id) FILTER (WHERE v.value = 1) AS yes_count, "
+  "       count(v.id) FILTER (WHERE v.value = 0) AS no_count "
+  "FROM choices c LEFT JOIN votes v ON v.choice_id = c.id "
+)
 
-def ensure_migration_table_exists() -> None:
+def rebuild_choice_tallies() -> int:
+  """Recounts the yes/no tallies of every choice from the votes, returns the number of fixed choices."""
   with db.cursor() as (conn, cur):
     try:
-      cur.execute("CREATE TABLE IF NOT EXISTS applied_migrations ("
-                  "number INTEGER PRIMARY KEY"
-                  ")")
+      cur.execute("WITH counted AS (" + TALLIES_SQL + "GROUP BY c.id) "
+                  "SELECT DISTINCT counted.poll_id FROM counted JOIN choices c ON c.id = counted.id "
+                  "WHERE (c.yes_count, c.no_count) <> (counted.yes_count, counted.no_count)")
+      # The polls are locked before their choices are, like every other write does
+      poll_ids = _lock_polls(cur, [row[0] for row in cur.fetchall()])
+      if not poll_ids:
+        conn.commit()
+        return 0
+
+      cur.execute("WITH counted AS (" + TALLIES_SQL + "WHERE c.poll_id = ANY(%s::uuid[]) GROUP BY c.id) "
+                  "UPDATE choices SET yes_count = counted.yes_count, no_count = counted.no_count "
+                  "FROM counted "
+                  "WHERE choices.id = counted.id "
+                  "AND (choices.yes_count, choices.no_count) <> (counted.yes_count, counted.no_count) "
+                  "RETURNING choices.poll_id", (poll_ids,))
+      fixed = cur.fetchall()
+      poll_ids = {row[0] for row in fixed}
+      for poll_id in poll_ids:
+        _poll_changed(cur, poll_id)
       conn.commit()
+      for poll_id in poll_ids:
+        poll_cache.invalidate(poll_id)
+      return len(fixed)
     except Exception as e:
       conn.rollback()
       raise e
 
-def ensure_migration_applied(number: int, migration_sql: str) -> bool:
-  """Returns True if the migration was applied, False if it was already applied."""
+@dataclass
+class PollSummary:
+  id: str
+  title: str
+  author_email: str | None
+  manage_code: str
+  voter_count: int
+
+def get_poll_summary(id: str) -> PollSummary | None:
+  """Returns what notifications need to know about a poll, without loading its choices and votes."""
   with db.cursor() as (conn, cur):
     try:
-      cur.execute("SELECT * FROM applied_migrations WHERE number = %s", (number,))
-      if cur.fetchone() is not None:
-        return False
+      cur.execute("SELECT p.id, p.title, p.author_email, p.manage_code, "
+                  "       (SELECT count(DISTINCT v.voter_name) FROM votes v WHERE v.poll_id = p.id) "
+                  "FROM polls p WHERE p.id = %s", (id,))
+      row = cur.fetchone()
+      conn.commit()
+      return PollSummary(*row) if row else None
+    except Exception as e:
+      conn.rollback()
+      raise e
+
+### Outbox
+
+# Background tasks are written to the outbox table in the transaction that
+# causes them and drained by any process with process_outbox_batch(). A NOTIFY
+# on this channel wakes up idle workers when a task is queued.
+OUTBOX_CHANNEL = "outbox"
+
+def _enqueue(cur,
+             kind: str,
+             payload: dict,
+             delay: float = 0,
+             coalesce_key: str | None = None) -> None:
+  """Queues a background task to run after delay seconds, call before commit.
+
+  Tasks with the same coalesce_key are handed to the handler together as
+  soon as the first of them is due.
+  """
+  cur.execute("INSERT INTO outbox (kind, payload, available_at, coalesce_key) "
+              "VALUES (%s, %s, CURRENT_TIMESTAMP + make_interval(secs => %s), %s)",
+              (kind, json.dumps(payload), delay, coalesce_key))
+  cur.execute("SELECT pg_notify(%s, '')", (OUTBOX_CHANNEL,))
+
+def process_outbox_batch(handle: Callable[[str, list[dict]], None],
+                         limit: int,
+                         max_attempts: int,
+                         retry_backoff: float,
+                         lease: float) -> int:
+  """Runs up to limit due tasks through handle, returns the number of tasks taken.
+
+  The tasks are leased for lease seconds in a short transaction of their own,
+  concurrent workers skip them until the lease runs out, and handle runs
+  without holding a transaction or a connection. A task whose worker dies
+  while running it is taken again after its lease. A due task with a
+  coalesce key also takes every other pending task with that key, and the
+  handler gets all of their payloads in one call. Failed tasks are retried
+  with exponential backoff and given up after max_attempts.
+  """
+  tasks = _lease_outbox_tasks(limit, lease)
+
+  groups: dict[tuple[str, str | int], list[tuple]] = {}
+  for task in tasks:
+    groups.setdefault((task[1], task[4] or task[0]), []).append(task)
 
-      cur.execute("INSERT INTO applied_migrations (number) VALUES (%s)", (number,))
-      cur.execute(migration_sql)
+  for (kind, _), group in groups.items():
+    ids = [task[0] for task in group]
+    # Already counts this attempt
+    attempts = max(task[3] for task in group)
+    try:
+      handle(kind, [task[2] for task in group])
+    except Exception as e:
+      traceback.print_exc(file=sys.stderr)
+      if attempts >= max_attempts:
+        print(f"Giving up on outbox tasks {ids} ({kind}) after {attempts} attempts", file=sys.stderr)
+      _finish_outbox_tasks(ids, error=repr(e), give_up=attempts >= max_attempts,
+                           retry_delay=retry_backoff * 2 ** (attempts - 1))
+    else:
+      _finish_outbox_tasks(ids)
+  return len(tasks)
+
+# Tasks that are not leased by a running worker
+_UNLEASED = "(leased_until IS NULL OR leased_until <= CURRENT_TIMESTAMP)"
+
+def _lease_outbox_tasks(limit: int, lease: float) -> list[tuple]:
+  """Takes up to limit due tasks and the pending tasks coalesced with them.
+
+  Returns (id, kind, payload, attempts, coalesce_key) tuples, attempts
+  includes the attempt that is about to be made.
+  """
+  with db.cursor() as (conn, cur):
+    try:
+      cur.execute("SELECT id FROM outbox "
+                  f"WHERE failed_at IS NULL AND available_at <= CURRENT_TIMESTAMP AND {_UNLEASED} "
+                  "ORDER BY available_at "
+                  "LIMIT %s "
+                  "FOR UPDATE SKIP LOCKED", (limit,))
+      ids = [row[0] for row in cur.fetchall()]
+      if not ids:
+        conn.commit()
+        return []
+
+      cur.execute("WITH due AS ("
+                  "  SELECT coalesce_key FROM outbox WHERE id = ANY(%s) AND coalesce_key IS NOT NULL"
+                  "), coalesced AS ("
+                  "  SELECT id FROM outbox "
+                  f"  WHERE failed_at IS NULL AND {_UNLEASED} "
+                  "    AND coalesce_key IN (SELECT coalesce_key FROM due) AND id <> ALL(%s) "
+                  "  FOR UPDATE SKIP LOCKED"
+                  ") "
+                  "UPDATE outbox SET attempts = attempts + 1, "
+                  "  leased_until = CURRENT_TIMESTAMP + make_interval(secs => %s) "
+                  "WHERE id = ANY(%s) OR id IN (SELECT id FROM coalesced) "
+                  "RETURNING id, kind, payload, attempts, coalesce_key",
+                  (ids, ids, lease, ids))
+      tasks = sorted(cur.fetchall())
       conn.commit()
-      return True
+      return tasks
+    except Exception as e:
+      conn.rollback()
+      raise e
+
+def _finish_outbox_tasks(ids: list[int],
+                         error: str | None = None,
+                         give_up: bool = False,
+                         retry_delay: float = 0) -> None:
+  """Deletes tasks that ran, or releases failed ones for a retry after retry_delay seconds."""
+  with db.cursor() as (conn, cur):
+    try:
+      if error is None:
+        cur.execute("DELETE FROM outbox WHERE id = ANY(%s)", (ids,))
+      elif give_up:
+        cur.execute("UPDATE outbox SET leased_until = NULL, last_error = %s, "
+                    "failed_at = CURRENT_TIMESTAMP "
+                    "WHERE id = ANY(%s)", (error, ids))
+      else:
+        cur.execute("UPDATE outbox SET leased_until = NULL, last_error = %s, "
+                    "available_at = CURRENT_TIMESTAMP + make_interval(secs => %s) "
+                    "WHERE id = ANY(%s)", (error, retry_delay, ids))
+      conn.commit()
+    except Exception as e:
+      conn.rollback()
+      raise e
+
+def outbox_stats() -> dict[str, int]:
+  with db.cursor() as (conn, cur):
+    try:
+      cur.execute("SELECT count(*) FILTER (WHERE failed_at IS NULL), "
+                  "       count(*) FILTER (WHERE failed_at IS NULL AND available_at <= CURRENT_TIMESTAMP "
+                  f"                        AND {_UNLEASED}), "
+                  f"       count(*) FILTER (WHERE failed_at IS NULL AND NOT {_UNLEASED}), "
+                  "       count(*) FILTER (WHERE failed_at IS NOT NULL) "
+                  "FROM outbox")
+      pending, due, running, failed = cur.fetchone()
+      conn.commit()
+      return {"pending": pending, "due": due, "running": running, "failed": failed}
+    except Exception as e:
+      conn.rollback()
+      raise e
+
+### Migrations
+
+# Key of the advisory lock that serializes the migration runs of all replicas
+MIGRATION_LOCK_KEY = 0x6469646C65
+MIGRATION_LOCK_POLL_SECONDS = 1.0
 
+def connect_for_migrations():
+  """A connection of its own in autocommit mode, migrations control their transactions themselves."""
+  conn = db.connect()
+  conn.autocommit = True
+  return conn
+
+def get_applied_migrations(conn) -> dict[int, str | None] | None:
+  """Number -> checksum of the applied migrations in one query, None if there is no migration table.
+
+  Checksums are None for migrations applied before checksums were recorded,
+  or if the table does not have the checksum column yet.
+  """
+  with conn.cursor() as cur:
+    try:
+      cur.execute("SELECT * FROM applied_migrations")
+    except psycopg2.errors.UndefinedTable:
+      return None
+    columns = [column.name for column in cur.description]
+    rows = [dict(zip(columns, row)) for row in cur.fetchall()]
+  return {row["number"]: row.get("checksum") for row in rows}
+
+def lock_migrations(conn) -> None:
+  """Waits until no other process is running migrations.
+
+  Polls with pg_try_advisory_lock instead of waiting in pg_advisory_lock: a
+  statement that waits holds a snapshot, and CREATE INDEX CONCURRENTLY run by
+  the lock holder would wait for that snapshot in turn.
+  """
+  with conn.cursor() as cur:
+    while True:
+      cur.execute("SELECT pg_try_advisory_lock(%s)", (MIGRATION_LOCK_KEY,))
+      if cur.fetchone()[0]:
+        return
+      time.sleep(MIGRATION_LOCK_POLL_SECONDS)
+
+def unlock_migrations(conn) -> None:
+  with conn.cursor() as cur:
+    cur.execute("SELECT pg_advisory_unlock(%s)", (MIGRATION_LOCK_KEY,))
+
+def ensure_migration_table_exists(conn) -> None:
+  with conn.cursor() as cur:
+    cur.execute("CREATE TABLE IF NOT EXISTS applied_migrations ("
+                "number INTEGER PRIMARY KEY"
+                ")")
+    cur.execute("ALTER TABLE applied_migrations "
+                "ADD COLUMN IF NOT EXISTS checksum TEXT, "
+                "ADD COLUMN IF NOT EXISTS applied_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP")
+
+def record_migration_checksum(conn, number: int, checksum: str) -> None:
+  """Stores the checksum of a migration applied before checksums were recorded."""
+  with conn.cursor() as cur:
+    cur.execute("UPDATE applied_migrations SET checksum = %s WHERE number = %s AND checksum IS NULL",
+                (checksum, number))
+
+def apply_migration(conn, number: int, checksum: str, statements: list[str], transactional: bool) -> None:
+  """Runs the statements of a migration and records it as applied.
+
+  A transactional migration is applied atomically. The statements of a
+  non-transactional one run one by one, as CREATE INDEX CONCURRENTLY must, and
+  the migration is only recorded once all of them succeeded, so a failed one
+  is run again from the start.
+  """
+  with conn.cursor() as cur:
+    if not transactional:
+      for statement in statements:
+        cur.execute(statement)
+      cur.execute("INSERT INTO applied_migrations (number, checksum) VALUES (%s, %s)",
+                  (number, checksum))
+      return
+
+    conn.autocommit = False
+    try:
+      for statement in statements:
+        cur.execute(statement)
+      cur.execute("INSERT INTO applied_migrations (number, checksum) VALUES (%s, %s)",
+                  (number, checksum))
+      conn.commit()
     except Exception as e:
       conn.rollback()
       raise e
+    finally:
+      conn.autocommit = True
@@ -1,9 +1,7 @@
 import os
 import sys
-import traceback
-import smtplib
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
+import threading
+import time
 
 import db
 
@@ -12,6 +10,36 @@ BASE_URL = os.environ["BASE_URL"]
 def send_email(subject: str, body: str, recipient: str):
   pass
 
+# Seconds a cached SMTP session may sit unused before it is replaced instead
+# of reused, servers typically drop idle clients after a few minutes
+EMAIL_SESSION_MAX_IDLE = float(os.getenv("EMAIL_SESSION_MAX_IDLE", "60"))
+EMAIL_MAX_ATTEMPTS = int(os.getenv("EMAIL_MAX_ATTEMPTS", "4"))
+EMAIL_RETRY_BACKOFF = float(os.getenv("EMAIL_RETRY_BACKOFF", "0.5"))
+EMAIL_TIMEOUT = float(os.getenv("EMAIL_TIMEOUT", "30"))
+# Seconds participations are collected into one digest email, 0 sends one email per participation
+EMAIL_DIGEST_WINDOW = float(os.getenv("EMAIL_DIGEST_WINDOW", "0"))
+
+_stats_lock = threading.Lock()
+_stats = {
+  "sent": 0,
+  "failed": 0,
+  "retries": 0,
+  "connections": 0,
+  "send_seconds_total": 0.0,
+  "send_seconds_max": 0.0,
+}
+
+def _record(**increments) -> None:
+  with _stats_lock:
+    for key, value in increments.items():
+      _stats[key] += value
+
+def stats() -> dict[str, float]:
+  with _stats_lock:
+    result = dict(_stats)
+  result["send_seconds_avg"] = result["send_seconds_total"] / result["sent"] if result["sent"] else 0.0
+  return result
+
 email_env_vars = [
   "EMAIL_HOST",
   "EMAIL_PORT",
@@ -43,6 +71,53 @@ if email_enabled:
 
   print(f"SMTP email client enabled using email host {email_host}")
 
+  # Only imported when emails are enabled, this keeps them out of worker start up otherwise
+  import smtplib
+  from email.mime.multipart import MIMEMultipart
+  from email.mime.text import MIMEText
+
+  # Every sending thread keeps its own authenticated session
+  _session = threading.local()
+
+  def _smtp_connection() -> smtplib.SMTP:
+    server = getattr(_session, "server", None)
+    if server is not None and time.monotonic() - _session.last_used > EMAIL_SESSION_MAX_IDLE:
+      _drop_connection()
+      server = None
+
+    if server is None:
+      server = smtplib.SMTP(email_host, email_port, timeout=EMAIL_TIMEOUT)
+      try:
+        if email_use_tls:
+          server.starttls()
+        server.login(email_host_user, email_host_password)
+      except Exception:
+        server.close()
+        raise
+      _session.server = server
+      _session.last_used = time.monotonic()
+      _record(connections=1)
+
+    return server
+
+  def _drop_connection():
+    server = getattr(_session, "server", None)
+    _session.server = None
+    if server is None:
+      return
+    try:
+      server.quit()
+    except (smtplib.SMTPException, OSError):
+      server.close()
+
+  def _is_transient(e: Exception) -> bool:
+    if isinstance(e, smtplib.SMTPResponseException):
+      # 4xx replies are temporary failures, 5xx are permanent
+      return 400 <= e.smtp_code < 500
+    if isinstance(e, (smtplib.SMTPRecipientsRefused, smtplib.SMTPSenderRefused)):
+      return False
+    return isinstance(e, OSError)
+
   def _actual_send_email(subject: str, body: str, recipient: str):
     if not email_enabled:
       return
@@ -56,19 +131,36 @@ if email_enabled:
     for key, value in email_headers.items():
       msg.add_header(key, value)
 
-    with smtplib.SMTP(email_host, email_port) as server:
-      if email_use_tls:
-        server.starttls()
-
-      server.login(email_host_user, email_host_password)
-      server.send_message(msg)
+    start = time.monotonic()
+    for attempt in range(EMAIL_MAX_ATTEMPTS):
+      try:
+        server = _smtp_connection()
+        server.send_message(msg)
+        _session.last_used = time.monotonic()
+        elapsed = _session.last_used - start
+        with _stats_lock:
+          _stats["sent"] += 1
+          _stats["send_seconds_total"] += elapsed
+          _stats["send_seconds_max"] = max(_stats["send_seconds_max"], elapsed)
+        print(f"Sent email to {recipient} in {elapsed * 1000:.0f} ms")
+        return
+      except Exception as e:
+        # The session may be in an unknown state, start over with a new one
+        _drop_connection()
+        if not _is_transient(e) or attempt == EMAIL_MAX_ATTEMPTS - 1:
+          _record(failed=1)
+          raise
+        _record(retries=1)
+        delay = EMAIL_RETRY_BACKOFF * 2 ** attempt
+        print(f"Sending email to {recipient} failed ({e}), retrying in {delay:.1f}s", file=sys.stderr)
+        time.sleep(delay)
 
   send_email = _actual_send_email
 else:
   print("SMTP email client not enabled")
 
 def send_participation_email(poll_id: str, voter_name: str):
-  poll = db.get_poll(poll_id)
+  poll = db.get_poll_summary(poll_id)
   if not poll or poll.author_email is None or poll.author_email.strip() == "":
     return
 
@@ -83,11 +175,40 @@ def send_participation_email(poll_id: str, voter_name: str):
       recipient=poll.author_email,
     )
   except Exception as e:
-    traceback.print_exc(file=sys.stderr)
     print(f"Failed to send participation email to {poll.author_email}", file=sys.stderr)
+    # Let the outbox retry the task
+    raise e
+
+def send_participation_digest_email(poll_id: str, voter_names: list[str]):
+  poll = db.get_poll_summary(poll_id)
+  if not poll or poll.author_email is None or poll.author_email.strip() == "":
+    return
+
+  if len(voter_names) == 1:
+    subject = f"{voter_names[0]} participated in your poll \"{poll.title}\""
+  else:
+    subject = f"{len(voter_names)} people participated in your poll \"{poll.title}\""
+  new_voters = "".join(f"  - {voter_name}\n" for voter_name in voter_names)
+
+  print(f"Sending participation digest of {len(voter_names)} voters to {poll.author_email}")
+  try:
+    send_email(
+      subject=subject,
+      body=f"New participants in your diddle \"{poll.title}\":\n\n"
+            f"{new_voters}\n"
+            f"{poll.voter_count} people have participated so far.\n\n"
+            f"View the results at {BASE_URL}/poll/{poll.id}\n"
+            f"Manage your diddle at {BASE_URL}/manage/{poll.manage_code}\n"
+            "You will be notified by email when someone participates.",
+      recipient=poll.author_email,
+    )
+  except Exception as e:
+    print(f"Failed to send participation digest email to {poll.author_email}", file=sys.stderr)
+    # Let the outbox retry the task
+    raise e
 
 def send_poll_created_email(poll_id: str):
-  poll = db.get_poll(poll_id)
+  poll = db.get_poll_summary(poll_id)
   if not poll or poll.author_email is None or poll.author_email.strip() == "":
     return
 
@@ -100,5 +221,6 @@ def send_poll_created_email(poll_id: str):
       recipient=poll.author_email,
     )
   except Exception as e:
-    traceback.print_exc(file=sys.stderr)
     print(f"Failed to send poll created email to {poll.author_email}", file=sys.stderr)
+    # Let the outbox retry the task
+    raise e
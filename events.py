@@ -0,0 +1,92 @@
+import json
+import os
+import queue
+import threading
+
+import db
+
+# Live poll updates are disabled by default, every open stream holds a worker
+# thread or greenlet. Enable them with the gevent worker, see
+# GUNICORN_WORKER_CLASS, where an idle stream only costs a greenlet.
+SSE_MAX_SUBSCRIBERS = int(os.getenv("SSE_MAX_SUBSCRIBERS", "0"))
+SSE_HEARTBEAT_SECONDS = float(os.getenv("SSE_HEARTBEAT_SECONDS", "15"))
+# Streams are closed after this long, browsers reconnect on their own
+SSE_MAX_STREAM_SECONDS = float(os.getenv("SSE_MAX_STREAM_SECONDS", "300"))
+
+# Sent to every subscriber when notifications may have been missed
+RESYNC_PAYLOAD = json.dumps({"event": "changed", "version": None})
+
+class EventHub:
+  """Fans the poll change notifications of this process out to open event streams."""
+  SUBSCRIBER_QUEUE_SIZE = 100
+
+  def __init__(self, max_subscribers: int):
+    self.max_subscribers = max_subscribers
+    self._lock = threading.Lock()
+    self._subscribers: dict[str, set[queue.Queue[str]]] = {}
+    self._count = 0
+
+  @property
+  def enabled(self) -> bool:
+    return self.max_subscribers > 0
+
+  def subscribe(self, poll_id: str) -> queue.Queue[str] | None:
+    """Returns a queue of notification payloads for the poll, None if the hub is full."""
+    with self._lock:
+      if self._count >= self.max_subscribers:
+        return None
+      subscriber: queue.Queue[str] = queue.Queue(maxsize=self.SUBSCRIBER_QUEUE_SIZE)
+      self._subscribers.setdefault(poll_id, set()).add(subscriber)
+      self._count += 1
+      return subscriber
+
+  def unsubscribe(self, poll_id: str, subscriber: queue.Queue[str]) -> None:
+    with self._lock:
+      subscribers = self._subscribers.get(poll_id)
+      if subscribers is None or subscriber not in subscribers:
+        return
+      subscribers.discard(subscriber)
+      if not subscribers:
+        del self._subscribers[poll_id]
+      self._count -= 1
+
+  def _send(self, subscriber: queue.Queue[str], payload: str) -> None:
+    try:
+      subscriber.put_nowait(payload)
+    except queue.Full:
+      # The stream is not keeping up, it has to reload the page anyway
+      pass
+
+  def publish(self, payload: str) -> None:
+    poll_id = json.loads(payload)["poll_id"]
+    with self._lock:
+      subscribers = list(self._subscribers.get(poll_id, ()))
+    for subscriber in subscribers:
+      self._send(subscriber, payload)
+
+  def resync(self) -> None:
+    with self._lock:
+      subscribers = [s for poll_subscribers in self._subscribers.values() for s in poll_subscribers]
+    for subscriber in subscribers:
+      self._send(subscriber, RESYNC_PAYLOAD)
+
+  def stats(self) -> dict[str, int]:
+    with self._lock:
+      return {
+        "subscribers": self._count,
+        "max_subscribers": self.max_subscribers,
+        "polls": len(self._subscribers),
+      }
+
+hub = EventHub(SSE_MAX_SUBSCRIBERS)
+db.listener.subscribe(db.POLL_CHANGED_CHANNEL, hub.publish)
+db.listener.on_reset(hub.resync)
+
+def format_event(payload: str) -> str:
+  """Formats a notification payload as a server-sent event."""
+  message = json.loads(payload)
+  lines = [f"event: {message['event']}"]
+  if message.get("version") is not None:
+    lines.append(f"id: {message['version']}")
+  lines.append(f"data: {payload}")
+  return "\n".join(lines) + "\n\n"
@@ -0,0 +1,110 @@
+import datetime
+import os
+import threading
+import time
+from typing import Any, Callable, Iterable, Iterator
+
+from flask import current_app
+from markupsafe import Markup
+
+import db
+from cache import SizedLruCache
+
+# Rendered fragments are keyed by poll version, so they never have to be
+# invalidated, old versions simply fall out of the cache
+FRAGMENT_CACHE_SIZE = int(os.getenv("FRAGMENT_CACHE_SIZE", str(32 * 1024 * 1024)))
+
+fragment_cache: SizedLruCache[tuple[list, float]] = SizedLruCache(max_size=FRAGMENT_CACHE_SIZE)
+
+_lock = threading.Lock()
+_render_seconds = 0.0
+_render_seconds_saved = 0.0
+
+def _macros():
+  return current_app.jinja_env.get_template("poll_fragments.html.j2").module
+
+def _part_size(part: Any) -> int:
+  if isinstance(part, tuple):
+    return sum(len(p) for p in part)
+  return len(part)
+
+def _cached_parts(key: tuple, render: Callable[[], Iterable]) -> Iterator:
+  """Yields the cached parts for key, or renders them and caches them once all were consumed.
+
+  Parts are yielded as they are rendered so that streamed pages do not wait
+  for the whole fragment. Only the time spent rendering is measured, not the
+  time the consumer takes between parts.
+  """
+  global _render_seconds, _render_seconds_saved
+
+  cached = fragment_cache.get(key)
+  if cached is not None:
+    parts, seconds = cached
+    with _lock:
+      _render_seconds_saved += seconds
+    yield from parts
+    return
+
+  parts = []
+  seconds = 0.0
+  rendered = iter(render())
+  while True:
+    start = time.perf_counter()
+    try:
+      part = next(rendered)
+    except StopIteration:
+      break
+    finally:
+      seconds += time.perf_counter() - start
+    parts.append(part)
+    yield part
+
+  with _lock:
+    _render_seconds += seconds
+  if fragment_cache.enabled:
+    fragment_cache.put(key, (parts, seconds), sum(_part_size(part) for part in parts))
+
+def _paged_parts(poll: db.Poll, key: tuple, render: Callable[[], Iterable]) -> Iterator:
+  """Like _cached_parts(), but polls whose votes are paged from the database are streamed uncached.
+
+  Caching would keep their whole vote table in memory, and rows read after
+  the poll was loaded may belong to a newer version than the key says.
+  """
+  if poll.results is None:
+    return iter(render())
+  return _cached_parts(key, render)
+
+def table_header(poll: db.Poll, now: datetime.datetime) -> Markup:
+  """The header row of the vote table with the choices and their tallies."""
+  def render():
+    yield Markup(_macros().table_header(poll, poll.choices, poll.best_choice_ids(), now))
+  [header] = _cached_parts((poll.id, poll.version, now.year, "table_header"), render)
+  return header
+
+def voter_rows(poll: db.Poll) -> Iterator[tuple[str, Markup]]:
+  """Yields (voter name, rendered vote cells) for the vote table.
+
+  The name cell is left to the page, it depends on who is viewing it.
+  """
+  def render():
+    voter_cells = _macros().voter_cells
+    for row in poll.voter_rows():
+      yield row.name, Markup(voter_cells(row))
+  return _paged_parts(poll, (poll.id, poll.version, "voter_rows"), render)
+
+def choice_items(poll: db.Poll, now: datetime.datetime) -> Iterator[Markup]:
+  """Yields the rendered choices of the vote list, including who voted for them."""
+  def render():
+    choice_item = _macros().choice_item
+    best_choice_ids = poll.best_choice_ids()
+    for choice, yes_voters in zip(poll.choices, poll.yes_voters_by_choice()):
+      yield Markup(choice_item(poll, choice, yes_voters, best_choice_ids, now))
+  return _paged_parts(poll, (poll.id, poll.version, now.year, "choice_items"), render)
+
+def stats() -> dict[str, Any]:
+  with _lock:
+    return {
+      **fragment_cache.stats(),
+      "render_seconds": _render_seconds,
+      "render_seconds_saved": _render_seconds_saved,
+    }
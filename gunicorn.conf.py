@@ -0,0 +1,38 @@
+import os
+
+bind = "0.0.0.0:8000"
+workers = int(os.getenv("GUNICORN_WORKERS", "4"))
+threads = int(os.getenv("GUNICORN_THREADS", "1"))
+
+# "gevent" serves every request from a greenlet instead of a thread, so that a
+# worker can hold many idle live update streams (SSE_MAX_SUBSCRIBERS). With the
+# default "sync", GUNICORN_THREADS above 1 switches to the gthread worker.
+worker_class = os.getenv("GUNICORN_WORKER_CLASS", "sync")
+# Concurrent requests and streams per gevent worker
+worker_connections = int(os.getenv("GUNICORN_WORKER_CONNECTIONS", "1000"))
+
+# Import the app and compile its templates once in the master, workers are
+# forked with everything loaded. Database connections and background threads
+# are only opened in the workers.
+preload_app = os.getenv("GUNICORN_PRELOAD", "true").lower() in ["true", "1", "yes"]
+if worker_class == "gevent":
+  # gevent patches the standard library when the worker starts, locks created
+  # by an app imported before that in the master would block the whole worker
+  preload_app = False
+
+def on_starting(server):
+  # Metrics of an earlier run would otherwise be merged into this one
+  import metrics
+  metrics.registry.clear_directory()
+
+def post_worker_init(worker):
+  if worker_class == "gevent":
+    # psycopg2 waits for the server in C, every query would block all
+    # greenlets of the worker. Connections are only opened after this.
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+def worker_exit(server, worker):
+  # Also covers workers that exit without running atexit handlers
+  import metrics
+  metrics.registry.flush(force=True)
@@ -0,0 +1,293 @@
+"""Per-request timings and Prometheus metrics shared by all worker processes.
+
+The timings of the request being handled by the current thread are collected
+in a RequestTimings object, the database layer adds its queries to it without
+knowing about Flask. Finished requests are recorded in histograms per
+endpoint.
+
+Every process writes its metrics to a JSON file of its own in METRICS_DIR,
+from a background thread every METRICS_FLUSH_SECONDS and once more when it
+exits. The /metrics endpoint merges the files of all processes, so it
+reports the same numbers whichever gunicorn worker serves it. Counters of
+processes that have exited are kept, gauges only come from live processes.
+"""
+import atexit
+import contextvars
+import json
+import os
+import sys
+import tempfile
+import threading
+import time
+import traceback
+from typing import Any, Callable
+
+METRICS_DIR = os.getenv("METRICS_DIR") or os.path.join(tempfile.gettempdir(), "diddle-metrics")
+# Seconds between writes of a process's metrics file
+METRICS_FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "2"))
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+class RequestTimings:
+  __slots__ = ("start", "db_queries", "db_seconds", "db_statements", "render_seconds",
+               "compress_seconds", "streaming")
+
+  def __init__(self):
+    self.start = time.perf_counter()
+    self.db_queries = 0
+    self.db_seconds = 0.0
+    # statement -> number of times it was executed
+    self.db_statements: dict[Any, int] = {}
+    self.render_seconds = 0.0
+    self.compress_seconds = 0.0
+    self.streaming = False
+
+  def elapsed(self) -> float:
+    return time.perf_counter() - self.start
+
+  def server_timing(self) -> str:
+    """The timings so far as a Server-Timing header value, durations in milliseconds."""
+    parts = [f'db;dur={self.db_seconds * 1000:.1f};desc="{self.db_queries} queries"']
+    if not self.streaming:
+      parts.append(f"render;dur={self.render_seconds * 1000:.1f}")
+    if self.compress_seconds:
+      parts.append(f"compress;dur={self.compress_seconds * 1000:.1f}")
+    parts.append(f"total;dur={self.elapsed() * 1000:.1f}")
+    return ", ".join(parts)
+
+_current: contextvars.ContextVar[RequestTimings | None] = \
+  contextvars.ContextVar("request_timings", default=None)
+
+def start_request() -> RequestTimings:
+  timings = RequestTimings()
+  _current.set(timings)
+  return timings
+
+def end_request() -> None:
+  _current.set(None)
+
+def current() -> RequestTimings | None:
+  return _current.get()
+
+def record_query(seconds: float, statement: Any = None) -> None:
+  timings = _current.get()
+  if timings is not None:
+    timings.db_queries += 1
+    timings.db_seconds += seconds
+    if statement is not None:
+      timings.db_statements[statement] = timings.db_statements.get(statement, 0) + 1
+
+def record_render(seconds: float) -> None:
+  timings = _current.get()
+  if timings is not None:
+    timings.render_seconds += seconds
+
+def record_compress(seconds: float) -> None:
+  timings = _current.get()
+  if timings is not None:
+    timings.compress_seconds += seconds
+
+LabelValues = tuple[tuple[str, str], ...]
+
+class Registry:
+  """The histograms and counters of this process, written to METRICS_DIR by flush()."""
+  def __init__(self, directory: str):
+    self.directory = directory
+    self._lock = threading.Lock()
+    # name -> labels -> [bucket counts..., sum, count]
+    self._histograms: dict[str, dict[LabelValues, list[float]]] = {}
+    self._counters: dict[str, dict[LabelValues, float]] = {}
+    self._stats: dict[str, Callable[[], dict[str, Any]]] = {}
+    self._global_stats: dict[str, Callable[[], dict[str, Any]]] = {}
+    self._last_flush = 0.0
+    self._pid = os.getpid()
+    self._flusher_pid: int | None = None
+    os.register_at_fork(after_in_child=self._after_fork)
+    atexit.register(self._flush_at_exit)
+
+  def _after_fork(self) -> None:
+    # A forked child starts counting from zero in a file of its own
+    self._lock = threading.Lock()
+    self._histograms = {}
+    self._counters = {}
+    self._last_flush = 0.0
+    self._pid = os.getpid()
+
+  def observe(self, name: str, labels: dict[str, str], value: float) -> None:
+    key = tuple(sorted(labels.items()))
+    with self._lock:
+      histogram = self._histograms.setdefault(name, {}).get(key)
+      if histogram is None:
+        histogram = self._histograms[name][key] = [0.0] * (len(LATENCY_BUCKETS) + 2)
+      for i, bound in enumerate(LATENCY_BUCKETS):
+        if value <= bound:
+          histogram[i] += 1
+      histogram[-2] += value
+      histogram[-1] += 1
+
+  def inc(self, name: str, labels: dict[str, str], amount: float = 1) -> None:
+    key = tuple(sorted(labels.items()))
+    with self._lock:
+      counters = self._counters.setdefault(name, {})
+      counters[key] = counters.get(key, 0) + amount
+
+  def register_stats(self, group: str, stats: Callable[[], dict[str, Any]]) -> None:
+    """Exports the numbers returned by stats() as gauges named diddle_<group>_<key>."""
+    self._stats[group] = stats
+
+  def register_global_stats(self, group: str, stats: Callable[[], dict[str, Any]]) -> None:
+    """Like register_stats() for numbers that are the same in every process, e.g. counted in the database.
+
+    These are only computed when /metrics is scraped, and exported without a pid label.
+    """
+    self._global_stats[group] = stats
+
+  def global_gauges(self) -> dict[str, float]:
+    return _gauges(self._global_stats)
+
+  def _snapshot(self) -> dict:
+    gauges = _gauges(self._stats)
+
+    with self._lock:
+      return {
+        "pid": self._pid,
+        "histograms": {name: [[list(key), values] for key, values in series.items()]
+                       for name, series in self._histograms.items()},
+        "counters": {name: [[list(key), value] for key, value in series.items()]
+                     for name, series in self._counters.items()},
+        "gauges": gauges,
+      }
+
+  def flush(self, force: bool = False) -> None:
+    now = time.monotonic()
+    if not force and now - self._last_flush < METRICS_FLUSH_SECONDS:
+      return
+    self._last_flush = now
+
+    snapshot = self._snapshot()
+    os.makedirs(self.directory, exist_ok=True)
+    path = os.path.join(self.directory, f"{snapshot['pid']}.json")
+    # Written to a temporary file first, readers never see a partial file
+    tmp_path = f"{path}.{threading.get_ident()}.tmp"
+    with open(tmp_path, "w") as f:
+      json.dump(snapshot, f)
+    os.replace(tmp_path, path)
+
+  def ensure_flushing(self) -> None:
+    """Starts the thread that flushes this process's metrics, once per process.
+
+    Call it from the processes that serve requests or run tasks, also from
+    those forked after import, scripts that only import the modules do not
+    write metrics files.
+    """
+    if self._flusher_pid == os.getpid():
+      return
+    with self._lock:
+      if self._flusher_pid == os.getpid():
+        return
+      self._flusher_pid = os.getpid()
+    threading.Thread(target=self._flush_forever, name="metrics-flush", daemon=True).start()
+
+  def _flush_forever(self) -> None:
+    while True:
+      time.sleep(METRICS_FLUSH_SECONDS)
+      try:
+        self.flush(force=True)
+      except Exception:
+        traceback.print_exc(file=sys.stderr)
+
+  def _flush_at_exit(self) -> None:
+    # Counters of exited processes are kept, they must include the last requests
+    if self._flusher_pid == os.getpid():
+      self.flush(force=True)
+
+  def clear_directory(self) -> None:
+    """Removes the files of earlier runs, call once before the workers start."""
+    if not os.path.isdir(self.directory):
+      return
+    for name in os.listdir(self.directory):
+      if name.endswith(".json") or name.endswith(".tmp"):
+        os.remove(os.path.join(self.directory, name))
+
+def _gauges(groups: dict[str, Callable[[], dict[str, Any]]]) -> dict[str, float]:
+  gauges: dict[str, float] = {}
+  for group, stats in list(groups.items()):
+    try:
+      for key, value in stats().items():
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+          gauges[f"diddle_{group}_{key}"] = value
+    except Exception:
+      traceback.print_exc(file=sys.stderr)
+  return gauges
+
+registry = Registry(METRICS_DIR)
+
+def _is_alive(pid: int) -> bool:
+  try:
+    os.kill(pid, 0)
+    return True
+  except ProcessLookupError:
+    return False
+  except PermissionError:
+    return True
+
+def _escape(value: str) -> str:
+  return value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _format_labels(labels: LabelValues) -> str:
+  if not labels:
+    return ""
+  return "{" + ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels) + "}"
+
+def collect() -> str:
+  """Merges the metrics of all processes into the Prometheus text format."""
+  registry.flush(force=True)
+
+  histograms: dict[str, dict[LabelValues, list[float]]] = {}
+  counters: dict[str, dict[LabelValues, float]] = {}
+  gauges: dict[str, dict[str, float]] = {}
+  for name in sorted(os.listdir(registry.directory)):
+    if not name.endswith(".json"):
+      continue
+    try:
+      with open(os.path.join(registry.directory, name)) as f:
+        snapshot = json.load(f)
+    except (OSError, ValueError):
+      continue
+
+    for metric, series in snapshot["histograms"].items():
+      merged = histograms.setdefault(metric, {})
+      for key, values in series:
+        key = tuple(tuple(item) for item in key)
+        total = merged.setdefault(key, [0.0] * len(values))
+        merged[key] = [a + b for a, b in zip(total, values)]
+    for metric, series in snapshot["counters"].items():
+      merged = counters.setdefault(metric, {})
+      for key, value in series:
+        key = tuple(tuple(item) for item in key)
+        merged[key] = merged.get(key, 0) + value
+    if _is_alive(snapshot["pid"]):
+      for metric, value in snapshot["gauges"].items():
+        gauges.setdefault(metric, {})[str(snapshot["pid"])] = value
+
+  lines = []
+  for metric, series in sorted(histograms.items()):
+    lines.append(f"# TYPE {metric} histogram")
+    for key, values in sorted(series.items()):
+      for bound, count in zip(LATENCY_BUCKETS, values):
+        lines.append(f"{metric}_bucket{_format_labels(key + (('le', str(bound)),))} {int(count)}")
+      lines.append(f"{metric}_bucket{_format_labels(key + (('le', '+Inf'),))} {int(values[-1])}")
+      lines.append(f"{metric}_sum{_format_labels(key)} {values[-2]}")
+      lines.append(f"{metric}_count{_format_labels(key)} {int(values[-1])}")
+  for metric, series in sorted(counters.items()):
+    lines.append(f"# TYPE {metric} counter")
+    for key, value in sorted(series.items()):
+      lines.append(f"{metric}{_format_labels(key)} {value}")
+  for metric, by_pid in sorted(gauges.items()):
+    lines.append(f"# TYPE {metric} gauge")
+    for pid, value in sorted(by_pid.items()):
+      lines.append(f"{metric}{_format_labels((('pid', pid),))} {value}")
+  for metric, value in sorted(registry.global_gauges().items()):
+    lines.append(f"# TYPE {metric} gauge")
+    lines.append(f"{metric} {value}")
+  return "\n".join(lines) + "\n"
@@ -0,0 +1 @@
+ALTER TABLE polls ADD COLUMN IF NOT EXISTS version BIGINT NOT NULL DEFAULT 0;
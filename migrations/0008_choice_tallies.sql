@@ -0,0 +1,40 @@
+ALTER TABLE choices ADD COLUMN IF NOT EXISTS yes_count INTEGER NOT NULL DEFAULT 0;
+ALTER TABLE choices ADD COLUMN IF NOT EXISTS no_count INTEGER NOT NULL DEFAULT 0;
+
+-- Keeps choices.yes_count and choices.no_count in sync with the votes table
+CREATE OR REPLACE FUNCTION update_choice_tallies() RETURNS trigger AS $$
+BEGIN
+  IF TG_OP IN ('DELETE', 'UPDATE') THEN
+    UPDATE choices
+    SET yes_count = yes_count - (OLD.value = 1)::int,
+        no_count = no_count - (OLD.value = 0)::int
+    WHERE id = OLD.choice_id;
+  END IF;
+
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    UPDATE choices
+    SET yes_count = yes_count + (NEW.value = 1)::int,
+        no_count = no_count + (NEW.value = 0)::int
+    WHERE id = NEW.choice_id;
+  END IF;
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS votes_update_choice_tallies ON votes;
+CREATE TRIGGER votes_update_choice_tallies
+AFTER INSERT OR DELETE OR UPDATE OF value, choice_id ON votes
+FOR EACH ROW EXECUTE FUNCTION update_choice_tallies();
+
+-- Backfill the tallies of existing votes
+UPDATE choices c
+SET yes_count = t.yes_count, no_count = t.no_count
+FROM (
+  SELECT choice_id,
+         count(*) FILTER (WHERE value = 1) AS yes_count,
+         count(*) FILTER (WHERE value = 0) AS no_count
+  FROM votes
+  GROUP BY choice_id
+) t
+WHERE c.id = t.choice_id;
@@ -0,0 +1,3 @@
+ALTER TABLE outbox ADD COLUMN IF NOT EXISTS coalesce_key TEXT;
+
+CREATE INDEX IF NOT EXISTS idx_outbox_pending_coalesce_key ON outbox (coalesce_key) WHERE failed_at IS NULL;
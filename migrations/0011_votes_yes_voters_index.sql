@@ -0,0 +1,7 @@
+-- migrate:no-transaction
+-- The yes voters of a choice in name order, read a few choices at a time for
+-- the vote list of large polls. Built concurrently so that votes can still be
+-- written while it is built. An interrupted build leaves an invalid index
+-- behind, dropping it first builds it again when the migration is retried.
+DROP INDEX CONCURRENTLY IF EXISTS idx_votes_choice_id_yes_voter_name;
+CREATE INDEX CONCURRENTLY idx_votes_choice_id_yes_voter_name ON votes (choice_id, voter_name) WHERE value = 1;
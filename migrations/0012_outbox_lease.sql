@@ -0,0 +1 @@
+ALTER TABLE outbox ADD COLUMN IF NOT EXISTS leased_until TIMESTAMP WITH TIME ZONE;
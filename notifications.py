@@ -0,0 +1,114 @@
+import os
+import select
+import sys
+import threading
+import time
+import traceback
+from typing import Any, Callable
+
+import psycopg2
+import psycopg2.extensions
+
+NotificationHandler = Callable[[str], None]
+
+class NotifyListener:
+  """Runs one LISTEN connection per process and fans notifications out to handlers.
+
+  The connection is opened by a daemon thread that is started lazily by
+  ensure_started(), so a process that forks after importing this module gets
+  its own listener. While the listener is not connected notifications may be
+  missed, which is why reset handlers are called every time it (re)connects.
+  """
+  RECONNECT_DELAY_SECONDS = 1.0
+  POLL_INTERVAL_SECONDS = 5.0
+
+  def __init__(self, connect: Callable[[], Any]):
+    self.connect = connect
+    self._handlers: dict[str, list[NotificationHandler]] = {}
+    self._reset_handlers: list[Callable[[], None]] = []
+    self._lock = threading.Lock()
+    self._pid: int | None = None
+    self._connected = False
+    self._connected_event = threading.Event()
+
+  @property
+  def connected(self) -> bool:
+    return self._connected and self._pid == os.getpid()
+
+  def wait_connected(self, timeout: float) -> bool:
+    """Starts the listener if needed and waits up to timeout seconds for it to connect."""
+    self.ensure_started()
+    return self._connected_event.wait(timeout) and self.connected
+
+  def subscribe(self, channel: str, handler: NotificationHandler) -> None:
+    with self._lock:
+      self._handlers.setdefault(channel, []).append(handler)
+
+  def on_reset(self, handler: Callable[[], None]) -> None:
+    with self._lock:
+      self._reset_handlers.append(handler)
+
+  def ensure_started(self) -> None:
+    if self._pid == os.getpid():
+      return
+
+    with self._lock:
+      if self._pid == os.getpid():
+        return
+      self._pid = os.getpid()
+      self._connected = False
+      self._connected_event.clear()
+      threading.Thread(target=self._run, name="notify-listener", daemon=True).start()
+
+  def _reset(self) -> None:
+    for handler in list(self._reset_handlers):
+      handler()
+
+  def _dispatch(self, channel: str, payload: str) -> None:
+    for handler in list(self._handlers.get(channel, [])):
+      try:
+        handler(payload)
+      except Exception:
+        traceback.print_exc(file=sys.stderr)
+
+  def _listen(self) -> None:
+    conn = self.connect()
+    try:
+      conn.set_isolation_level(psycopg2.extensions.ISOLATION_LEVEL_AUTOCOMMIT)
+      with conn.cursor() as cur:
+        for channel in list(self._handlers):
+          cur.execute(f'LISTEN "{channel}"')
+
+      self._connected = True
+      self._reset()
+      self._connected_event.set()
+      print(f"Listening for notifications on {', '.join(self._handlers)}")
+
+      while True:
+        if select.select([conn], [], [], self.POLL_INTERVAL_SECONDS) == ([], [], []):
+          # Nothing arrived, make sure the connection is still alive
+          with conn.cursor() as cur:
+            cur.execute("SELECT 1")
+          continue
+
+        conn.poll()
+        while conn.notifies:
+          notify = conn.notifies.pop(0)
+          self._dispatch(notify.channel, notify.payload)
+    finally:
+      self._connected = False
+      self._connected_event.clear()
+      self._reset()
+      try:
+        conn.close()
+      except psycopg2.Error:
+        pass
+
+  def _run(self) -> None:
+    while True:
+      try:
+        self._listen()
+      except Exception:
+        traceback.print_exc(file=sys.stderr)
+        print("Notification listener disconnected, reconnecting", file=sys.stderr)
+      time.sleep(self.RECONNECT_DELAY_SECONDS)
@@ -0,0 +1,9 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import db
+
+# Recounts choices.yes_count and choices.no_count from the votes table, e.g.
+# after votes have been modified by hand with the tally trigger disabled.
+num_fixed = db.rebuild_choice_tallies()
+print(f"* Tallies of {num_fixed} choices rebuilt.")
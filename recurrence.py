@@ -0,0 +1,68 @@
+import datetime
+from typing import Collection
+
+# At most this many choices are created by one request
+MAX_CHOICES = 500
+# Rules may not span more days than this
+MAX_DAYS = 366
+
+ChoiceRange = tuple[datetime.datetime, datetime.datetime]
+
+def whole_day(date: datetime.date) -> ChoiceRange:
+  """The range a whole day choice covers, like a single choice added on the manage page."""
+  start = datetime.datetime.combine(date, datetime.time(0, 0))
+  return start, start.replace(hour=23, minute=59)
+
+def expand(first_date: datetime.date,
+           last_date: datetime.date,
+           weekdays: Collection[int],
+           start_time: datetime.time | None = None,
+           end_time: datetime.time | None = None,
+           slot_minutes: int | None = None) -> list[ChoiceRange]:
+  """The choices of a recurrence rule, e.g. weekdays 9 to 17 hourly for two weeks.
+
+  Every date from first_date to last_date that falls on one of weekdays
+  (0 is Monday) gets either one whole day choice, when no times are given,
+  one choice from start_time to end_time, or consecutive slots of
+  slot_minutes between them. Raises ValueError for rules that are invalid or
+  would create no choices or more than MAX_CHOICES.
+  """
+  if last_date < first_date:
+    raise ValueError("The last date must not be before the first date")
+  if (last_date - first_date).days >= MAX_DAYS:
+    raise ValueError(f"A series may span at most {MAX_DAYS} days")
+  if not weekdays:
+    raise ValueError("Select at least one weekday")
+  if (start_time is None) != (end_time is None):
+    raise ValueError("Give both a start and an end time, or neither for whole days")
+  if start_time is not None and start_time >= end_time:
+    raise ValueError("The start time must be before the end time")
+  if slot_minutes is not None and (start_time is None or slot_minutes <= 0):
+    raise ValueError("Slots need a start and an end time and a positive length")
+
+  ranges: list[ChoiceRange] = []
+  date = first_date
+  while date <= last_date:
+    if date.weekday() in weekdays:
+      if start_time is None:
+        ranges.append(whole_day(date))
+      else:
+        start = datetime.datetime.combine(date, start_time)
+        end = datetime.datetime.combine(date, end_time)
+        if slot_minutes is None:
+          ranges.append((start, end))
+        else:
+          step = datetime.timedelta(minutes=slot_minutes)
+          # Only whole slots, a remainder shorter than a slot is left out
+          while start + step <= end:
+            ranges.append((start, start + step))
+            start += step
+            if len(ranges) > MAX_CHOICES:
+              break
+      if len(ranges) > MAX_CHOICES:
+        raise ValueError(f"A series may create at most {MAX_CHOICES} options")
+    date += datetime.timedelta(days=1)
+  if not ranges:
+    # E.g. only weekdays that are not in the range, or a slot longer than the times
+    raise ValueError("Add at least one option")
+  return ranges
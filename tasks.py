@@ -0,0 +1,98 @@
+import os
+import sys
+import threading
+import traceback
+from typing import Callable
+
+import db
+import email_client
+import metrics
+
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "10"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "5"))
+OUTBOX_MAX_ATTEMPTS = int(os.getenv("OUTBOX_MAX_ATTEMPTS", "8"))
+OUTBOX_RETRY_BACKOFF = float(os.getenv("OUTBOX_RETRY_BACKOFF", "30"))
+# Must be longer than any batch takes to send, or its tasks are sent twice
+OUTBOX_LEASE = float(os.getenv("OUTBOX_LEASE", "300"))
+
+# Handlers get the payloads of all tasks that were coalesced into one run,
+# a single payload for tasks queued without a coalesce key
+Handler = Callable[[list[dict]], None]
+
+def send_poll_created_emails(payloads: list[dict]) -> None:
+  for payload in payloads:
+    email_client.send_poll_created_email(poll_id=payload["poll_id"])
+
+def send_participation_emails(payloads: list[dict]) -> None:
+  for payload in payloads:
+    email_client.send_participation_email(poll_id=payload["poll_id"],
+                                          voter_name=payload["voter_name"])
+
+def send_participation_digest_email(payloads: list[dict]) -> None:
+  voter_names = list(dict.fromkeys(payload["voter_name"] for payload in payloads))
+  email_client.send_participation_digest_email(poll_id=payloads[0]["poll_id"],
+                                               voter_names=voter_names)
+
+HANDLERS: dict[str, Handler] = {
+  "poll_created": send_poll_created_emails,
+  "participation": send_participation_emails,
+  "participation_digest": send_participation_digest_email,
+}
+
+def handle(kind: str, payloads: list[dict]) -> None:
+  handler = HANDLERS.get(kind)
+  if handler is None:
+    raise Exception(f"Unknown outbox task kind: {kind}")
+
+  # Counted like a request, so that handlers get the same query warnings
+  timings = metrics.start_request()
+  try:
+    handler(payloads)
+  finally:
+    metrics.end_request()
+    db.check_query_counts(timings, f"Outbox task {kind}")
+
+_wake_up = threading.Event()
+db.listener.subscribe(db.OUTBOX_CHANNEL, lambda _: _wake_up.set())
+
+def drain_forever() -> None:
+  print(f"Outbox worker {threading.current_thread().name} started")
+  while True:
+    db.listener.ensure_started()
+    try:
+      taken = db.process_outbox_batch(handle,
+                                      limit=OUTBOX_BATCH_SIZE,
+                                      max_attempts=OUTBOX_MAX_ATTEMPTS,
+                                      retry_backoff=OUTBOX_RETRY_BACKOFF,
+                                      lease=OUTBOX_LEASE)
+    except Exception:
+      traceback.print_exc(file=sys.stderr)
+      taken = 0
+    metrics.registry.flush()
+
+    if taken < OUTBOX_BATCH_SIZE:
+      # Sleep until a new task is queued, the interval also picks up retries
+      _wake_up.wait(OUTBOX_POLL_INTERVAL)
+      _wake_up.clear()
+
+def start_workers(count: int) -> list[threading.Thread]:
+  threads = [threading.Thread(target=drain_forever, name=f"outbox-{i}", daemon=True)
+             for i in range(count)]
+  for thread in threads:
+    thread.start()
+  return threads
+
+_workers_lock = threading.Lock()
+_workers_pid: int | None = None
+
+def ensure_workers(count: int) -> None:
+  """Starts the worker threads once per process, also in processes forked after import."""
+  global _workers_pid
+
+  if _workers_pid == os.getpid():
+    return
+  with _workers_lock:
+    if _workers_pid == os.getpid():
+      return
+    _workers_pid = os.getpid()
+    start_workers(count)
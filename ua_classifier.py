@@ -0,0 +1,65 @@
+import functools
+import os
+import threading
+from typing import Literal
+
+DeviceClass = Literal["mobile", "tablet", "desktop"]
+
+UA_CACHE_SIZE = int(os.getenv("UA_CACHE_SIZE", "1024"))
+# Longer user agents are truncated so that the cache stays bounded in bytes too
+UA_MAX_LENGTH = 512
+
+_lock = threading.Lock()
+_fast_path_hits = 0
+
+def _fast_path(ua: str) -> DeviceClass | None:
+  """Classifies the most common user agents without the full regex parser.
+
+  Returns None for anything it is not sure about, those go to user_agents.
+  """
+  if not ua:
+    return "desktop"
+  if "iPad" in ua:
+    return "tablet"
+  if "iPhone" in ua or "iPod" in ua:
+    return "mobile"
+  if "Android" in ua:
+    return "mobile" if "Mobile" in ua else "tablet"
+  if ("Windows NT" in ua or "Macintosh" in ua or "X11" in ua) \
+      and not any(token in ua for token in ("Mobile", "Tablet", "Touch", "Phone")):
+    return "desktop"
+  return None
+
+@functools.lru_cache(maxsize=UA_CACHE_SIZE)
+def _parse(ua: str) -> DeviceClass:
+  # Imported lazily, loading the ua-parser regexes is slow and rarely needed
+  from user_agents import parse as parse_user_agent
+
+  user_agent = parse_user_agent(ua)
+  if user_agent.is_tablet:
+    return "tablet"
+  if user_agent.is_mobile:
+    return "mobile"
+  return "desktop"
+
+def classify(ua: str) -> DeviceClass:
+  global _fast_path_hits
+
+  ua = ua[:UA_MAX_LENGTH]
+  device_class = _fast_path(ua)
+  if device_class is not None:
+    with _lock:
+      _fast_path_hits += 1
+    return device_class
+
+  return _parse(ua)
+
+def stats() -> dict[str, int]:
+  info = _parse.cache_info()
+  return {
+    "fast_path_hits": _fast_path_hits,
+    "cache_hits": info.hits,
+    "cache_misses": info.misses,
+    "cache_entries": info.currsize,
+    "cache_max_entries": info.maxsize or 0,
+  }
@@ -0,0 +1,22 @@
+from dotenv import load_dotenv
+load_dotenv()
+
+import os
+
+import db
+import email_client
+import metrics
+import tasks
+
+# Drains the outbox without serving HTTP. Run any number of these next to or
+# instead of the web processes, see BACKGROUND_WORKERS.
+num_workers = int(os.getenv("BACKGROUND_WORKERS", "2"))
+if num_workers < 1:
+  raise Exception("BACKGROUND_WORKERS must be at least 1 for the worker")
+
+metrics.registry.register_stats("db_pool", db.pool_stats)
+metrics.registry.register_stats("email", email_client.stats)
+metrics.registry.ensure_flushing()
+
+for thread in tasks.start_workers(num_workers):
+  thread.join()